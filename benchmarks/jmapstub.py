@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+"""Stub JMAP server for trying mbwatch's JMAP push without a mail server.
+
+Serves the session resource, Mailbox/get, Mailbox/changes and the event
+source of a single account (user 'me', password 'secret') with a fixed
+mailbox tree.
+
+Without --serve a JMAPEventSource watches the stub, mailboxes are changed
+one at a time and the notification latency is printed; wrong credentials
+are checked to stop the source. With --serve the stub only serves on PORT
+and changes a random mailbox every INTERVAL seconds, so that mbwatch can
+be run against it with --jmap STORE=http://127.0.0.1:PORT/jmap.
+
+usage: python benchmarks/jmapstub.py [CHANGES]
+       python benchmarks/jmapstub.py --serve PORT [INTERVAL]
+"""
+
+import base64
+import json
+import os
+import random
+import sys
+from threading import Condition, Event, Thread
+import time
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+ACCOUNT = 'A1'
+AUTH = 'Basic ' + base64.b64encode(b'me:secret').decode('ascii')
+# id -> (name, parent id, role)
+MAILBOXES = {'m1': ('Inbox', None, 'inbox'), 'm2': ('Work', None, None),
+             'm3': ('Sub', 'm2', None), 'm4': ('Shared', None, None),
+             'm5': ('f1', 'm4', None), 'm6': ('f2', 'm4', None)}
+# IMAP paths the mailboxes are expected at with '/' delimiter
+PATHS = {'m1': 'INBOX', 'm2': 'Work', 'm3': 'Work/Sub', 'm4': 'Shared',
+         'm5': 'Shared/f1', 'm6': 'Shared/f2'}
+
+
+class Account:
+    """Mailbox state of the account; the state grows with every change."""
+
+    def __init__(self):
+        self.cond = Condition()
+        self.state = 0
+        # (state, mailbox id)
+        self.changes = []
+
+    def change(self, boxid):
+        with self.cond:
+            self.state += 1
+            self.changes.append((self.state, boxid))
+            self.cond.notify_all()
+
+    def changed_since(self, state):
+        with self.cond:
+            return self.state, sorted(set(
+                boxid for st, boxid in self.changes if st > state))
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    # seconds between pings if the client doesn't ask for them
+    ping = 5
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, obj, code=200):
+        data = json.dumps(obj).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def authorized(self):
+        if self.headers.get('Authorization') == AUTH:
+            return True
+        self.send_response(401)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        return False
+
+    def do_GET(self):
+        if not self.authorized():
+            return
+        if self.path == '/jmap':
+            self.send_json({
+                'apiUrl': '/jmap/api',
+                'eventSourceUrl': '/jmap/events?types={types}'
+                                  '&closeafter={closeafter}&ping={ping}',
+                'primaryAccounts': {'urn:ietf:params:jmap:mail': ACCOUNT}})
+        elif self.path.startswith('/jmap/events'):
+            self.send_events()
+        else:
+            self.send_json({'type': 'notFound'}, 404)
+
+    def send_events(self):
+        account = self.server.account
+        ping = self.ping
+        for param in self.path.partition('?')[2].split('&'):
+            name, _, value = param.partition('=')
+            if name == 'ping' and value.isdigit():
+                ping = int(value)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.end_headers()
+        with account.cond:
+            seen = account.state
+        try:
+            while True:
+                with account.cond:
+                    if account.state == seen:
+                        account.cond.wait(ping)
+                    state = account.state
+                if state != seen:
+                    seen = state
+                    event = 'state', {'@type': 'StateChange', 'changed': {
+                        ACCOUNT: {'Mailbox': str(state)}}}
+                else:
+                    event = 'ping', {'@type': 'Ping', 'interval': ping}
+                self.wfile.write(('event: %s\ndata: %s\n\n' % (
+                    event[0], json.dumps(event[1]))).encode('utf-8'))
+                self.wfile.flush()
+        except (IOError, OSError):
+            pass                # client disconnected
+
+    def do_POST(self):
+        if not self.authorized():
+            return
+        length = int(self.headers.get('Content-Length', 0))
+        request = json.loads(self.rfile.read(length).decode('utf-8'))
+        responses = [self.call(method, args, cid)
+                     for method, args, cid in request['methodCalls']]
+        self.send_json({'methodResponses': responses})
+
+    def call(self, method, args, cid):
+        account = self.server.account
+        if method == 'Mailbox/get':
+            state, _ = account.changed_since(0)
+            return [method, {
+                'accountId': ACCOUNT, 'state': str(state),
+                'list': [{'id': boxid, 'name': name, 'parentId': parent,
+                          'role': role} for boxid, (name, parent, role)
+                         in sorted(MAILBOXES.items())]}, cid]
+        if method == 'Mailbox/changes':
+            since = int(args['sinceState'])
+            state, updated = account.changed_since(since)
+            return [method, {
+                'accountId': ACCOUNT, 'oldState': str(since),
+                'newState': str(state), 'hasMoreChanges': False,
+                'created': [], 'updated': updated, 'destroyed': []}, cid]
+        return ['error', {'type': 'unknownMethod'}, cid]
+
+
+class Server(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, port=0):
+        HTTPServer.__init__(self, ('127.0.0.1', port), Handler)
+        self.account = Account()
+
+    def start(self):
+        t = Thread(target=self.serve_forever)
+        t.daemon = True
+        t.start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/jmap' % self.server_address[1]
+
+
+def serve(port, interval):
+    server = Server(port)
+    server.start()
+    print("serving %s as me:secret, mailboxes %s" % (
+        server.url, ', '.join(sorted(PATHS.values()))))
+    while True:
+        time.sleep(interval)
+        boxid = random.choice(sorted(MAILBOXES))
+        print("changed %s" % PATHS[boxid])
+        server.account.change(boxid)
+
+
+def check(nchanges):
+    from mbwatch.eventsource import EventSourceError
+    from mbwatch.jmap import JMAPEventSource
+
+    server = Server()
+    server.start()
+    notified = []
+    received = Event()
+
+    def callback(path):
+        def notify(_, path=path):
+            notified.append((path, time.time()))
+            received.set()
+        return notify
+
+    callbacks = dict((path, callback(path)) for path in PATHS.values())
+    errors = []
+    stop = Event()
+    source = JMAPEventSource(server.url, 'me', 'secret', callbacks,
+                             errors.append, stop=stop)
+    source.start()
+    deadline = time.time() + 10
+    while source.state is None and time.time() < deadline:
+        time.sleep(0.01)
+    latencies, wrong = [], []
+    for i in range(nchanges):
+        boxid = sorted(MAILBOXES)[i % len(MAILBOXES)]
+        received.clear()
+        del notified[:]
+        changed = time.time()
+        server.account.change(boxid)
+        if not received.wait(5):
+            raise RuntimeError("no notification for %s" % PATHS[boxid])
+        path, notified_at = notified[0]
+        if path != PATHS[boxid]:
+            wrong.append((PATHS[boxid], path))
+        latencies.append(notified_at - changed)
+    stop.set()
+    latencies.sort()
+    print("%d changes: median %.1fms, max %.1fms, %d notified wrong "
+          "mailbox" % (nchanges, 1000 * latencies[len(latencies) // 2],
+                       1000 * latencies[-1], len(wrong)))
+
+    bad = JMAPEventSource(server.url, 'me', 'wrong', callbacks,
+                          errors.append)
+    bad.run()
+    denied = [e for e in errors if isinstance(e, EventSourceError)]
+    print("wrong password %s the source" %
+          ('stopped' if denied else "didn't stop"))
+    return not wrong and denied
+
+
+def main():
+    if sys.argv[1:2] == ['--serve']:
+        serve(int(sys.argv[2]),
+              float(sys.argv[3]) if len(sys.argv) > 3 else 10)
+    else:
+        ok = check(int(sys.argv[1]) if len(sys.argv) > 1 else 100)
+        raise SystemExit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
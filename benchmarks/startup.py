@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+"""Measure mbwatch startup time.
+
+Runs the help, list and watch paths against a generated maildir-only
+config, cold (empty cache directory) and warm (caches populated), and
+prints the median and minimum wall time of each. The watch path is timed
+until the first sync command is started.
+
+usage: python benchmarks/startup.py [RUNS] [CHANNELS]
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def make_config(tmp, nchannels):
+    lines = []
+    for i in range(nchannels):
+        for side in ('far', 'near'):
+            path = os.path.join(tmp, 'mail', '%s%d' % (side, i))
+            for box in ('INBOX', 'Archive', 'Sent'):
+                for sub in ('cur', 'new', 'tmp'):
+                    os.makedirs(os.path.join(path, box, sub))
+            lines += ['MaildirStore %s%d' % (side, i),
+                      'Path %s/' % path,
+                      'Inbox %s/INBOX' % path,
+                      '']
+        lines += ['Channel ch%d' % i,
+                  'Master :far%d:' % i,
+                  'Slave :near%d:' % i,
+                  'Patterns * !Sent',
+                  '']
+    config = os.path.join(tmp, 'mbsyncrc')
+    with open(config, 'w') as file:
+        file.write('\n'.join(lines))
+    return config
+
+
+def run(args, env, until=None):
+    cmd = [sys.executable, '-m', 'mbwatch.mbwatch'] + args
+    start = time.time()
+    proc = subprocess.Popen(cmd, cwd=ROOT, env=env, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT)
+    if until is None:
+        proc.communicate()
+        return time.time() - start
+    for line in iter(proc.stdout.readline, b''):
+        if line.startswith(until):
+            elapsed = time.time() - start
+            break
+    else:
+        raise RuntimeError("%s didn't print %r" % (cmd, until))
+    proc.kill()
+    proc.communicate()
+    return elapsed
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    nchannels = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    tmp = tempfile.mkdtemp(prefix='mbwatch-bench-')
+    try:
+        config = make_config(tmp, nchannels)
+        cache = os.path.join(tmp, 'cache')
+        env = dict(os.environ, XDG_CACHE_HOME=cache)
+        paths = [('help', ['--help'], None),
+                 ('list', ['-c', config, '--list', '-a'], None),
+                 ('watch', ['-c', config, '--no-netmon', '-e', 'true', '-a'],
+                  b'true ')]
+        print("%-6s %-5s %9s %9s" % ('path', 'cache', 'median', 'min'))
+        for name, args, until in paths:
+            for state in ('cold', 'warm'):
+                times = []
+                for _ in range(runs):
+                    if state == 'cold':
+                        shutil.rmtree(cache, ignore_errors=True)
+                    else:
+                        run(args, env, until)  # populate caches
+                    times.append(run(args, env, until))
+                times.sort()
+                print("%-6s %-5s %8.1fms %8.1fms" % (
+                    name, state, 1000 * times[len(times) // 2],
+                    1000 * times[0]))
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
@@ -17,9 +17,41 @@ def print_help():
 Copyright (C) 2015 Vyacheslav Levit <dev@vlevit.org>
 usage:
  mbwatch [flags] {{channel[:box,...]|group} ...|-a}
+ mbwatch [flags] -u USER[:CONFIG] ...
   -e, --command         syncing command (default is mbsync)
   -a, --all             operate on all defined channels
   -l, --list            list mailboxes instead of syncing them
+  -r, --refresh         refresh cached mailbox lists from the servers
+  -S, --subscribed      consider only subscribed IMAP mailboxes
+  -u, --tenant USER[:CONFIG]
+                        watch all channels of USER's config (default:
+                        ~USER/.mbsyncrc) and sync them as USER; may be
+                        repeated to serve several users from one process
+  -j, --jobs N          watch channels in N worker processes (default 1)
+  -F, --full            always sync both directions and all changes instead of
+                        passing --pull/--push/--new to the syncing command
+  -T, --timeout [CHANNEL=]SECONDS
+                        terminate sync commands running longer than SECONDS
+                        (for CHANNEL only if given) and retry them later
+  --cpu-limit SECONDS   limit CPU time of the sync command
+  --memory-limit MB     limit address space of the sync command
+  --cold-after SECONDS  poll mailboxes without changes for SECONDS (default
+                        86400 with --max-idle) instead of keeping them IDLE
+  --max-idle N          IDLE at most N mailboxes, poll the least active ones
+  -J, --journal FILE    keep pending syncs in FILE; after a restart sync
+                        them before all other mailboxes
+  --jmap STORE=URL      watch IMAP store STORE with JMAP push from the session
+                        resource URL instead of IDLE; may be repeated
+  --no-netmon           don't reconnect on network changes and resume
+  --low-power MODE      on, off or auto (on while running on battery): stop
+                        IDLE on mailboxes without priority and sync them in
+                        shared wakeup windows; without channels switch the
+                        mode of running instances
+  -p, --priority CHANNEL[:BOX,...]
+                        keep IDLE and sync immediately in low-power mode
+  -t, --trace FILE      write per-event tracing records to FILE
+  -P, --profile-dir DIR write profiles requested by SIGUSR1 (cpu) and
+                        SIGUSR2 (memory) to DIR (default: temp directory)
   -c, --config CONFIG   read an alternate config file (default: ~/.mbsyncrc)
   -D, --debug           print debugging messages
   -V, --verbose         verbose mode (display network traffic)
@@ -35,6 +67,22 @@ class Arguments:
     mbsyncrc = "~/.mbsyncrc"
     all_ = False
     list_ = False
+    refresh = False
+    subscribed = False
+    jobs = 1
+    tenants = []
+    full = False
+    timeouts = {}
+    rlimits = {}
+    cold_after = None
+    max_idle = None
+    journal = None
+    netmon = True
+    jmap = {}
+    low_power = None
+    priority = []
+    trace = None
+    profile_dir = None
     debug = False
     verbose = False
     quiet = False
@@ -60,8 +108,84 @@ def get_arguments():
             args.all_ = True
         elif arg in ('-l', '--list'):
             args.list_ = True
+        elif arg in ('-r', '--refresh'):
+            args.refresh = True
+        elif arg in ('-u', '--tenant'):
+            if len(cmd) > i + 1:
+                args.tenants.append(cmd[i + 1])
+            skip = True
+        elif arg in ('-j', '--jobs'):
+            if len(cmd) > i + 1:
+                try:
+                    args.jobs = int(cmd[i + 1])
+                except ValueError:
+                    args.jobs = 0
+            if args.jobs < 1:
+                args.error = "--jobs requires a positive number"
+                break
+            skip = True
+        elif arg in ('-S', '--subscribed'):
+            args.subscribed = True
+        elif arg in ('-F', '--full'):
+            args.full = True
+        elif arg in ('-T', '--timeout', '--cpu-limit', '--memory-limit',
+                     '--cold-after', '--max-idle'):
+            value = cmd[i + 1] if len(cmd) > i + 1 else ''
+            channel = None
+            if arg in ('-T', '--timeout') and '=' in value:
+                channel, value = value.rsplit('=', 1)
+            try:
+                value = int(value)
+            except ValueError:
+                value = 0
+            if value < 1:
+                args.error = "%s requires a positive number" % arg
+                break
+            if arg in ('-T', '--timeout'):
+                args.timeouts[channel] = value
+            elif arg == '--cpu-limit':
+                args.rlimits['RLIMIT_CPU'] = value
+            elif arg == '--memory-limit':
+                args.rlimits['RLIMIT_AS'] = value * 1024 * 1024
+            elif arg == '--cold-after':
+                args.cold_after = value
+            else:
+                args.max_idle = value
+            skip = True
+        elif arg in ('-J', '--journal'):
+            if len(cmd) > i + 1:
+                args.journal = cmd[i + 1]
+            skip = True
+        elif arg == '--jmap':
+            value = cmd[i + 1] if len(cmd) > i + 1 else ''
+            if '=' not in value:
+                args.error = "--jmap requires STORE=URL"
+                break
+            store, url = value.split('=', 1)
+            args.jmap[store] = url
+            skip = True
+        elif arg == '--no-netmon':
+            args.netmon = False
+        elif arg == '--low-power':
+            args.low_power = cmd[i + 1] if len(cmd) > i + 1 else None
+            if args.low_power not in ('on', 'off', 'auto'):
+                args.error = "--low-power requires on, off or auto"
+                break
+            skip = True
+        elif arg in ('-p', '--priority'):
+            if len(cmd) > i + 1:
+                args.priority.append(cmd[i + 1])
+            skip = True
+        elif arg in ('-t', '--trace'):
+            if len(cmd) > i + 1:
+                args.trace = cmd[i + 1]
+            skip = True
+        elif arg in ('-P', '--profile-dir'):
+            if len(cmd) > i + 1:
+                args.profile_dir = cmd[i + 1]
+            skip = True
         elif arg in ('-c', '--config'):
-            if len(args) > i + 1:
+            if len(cmd) > i + 1:
                 args.mbsyncrc = cmd[i + 1]
             skip = True
         elif arg in ('-D', '--debug'):
@@ -0,0 +1,138 @@
+from contextlib import contextmanager
+import json
+import logging
+import os
+import time
+
+
+logger = logging.getLogger(__name__)
+
+# increment when entries saved by older versions are wrong; 2 fixes escaped
+# delimiters
+MAILBOX_CACHE_VERSION = 2
+
+
+def get_cache_dir():
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(base, 'mbwatch')
+
+
+def _make_dir(dirname):
+    # cached configs contain passwords
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname, 0o700)
+
+
+def write_atomic(path, data, mode='w'):
+    """Write data to path so that readers see either old or new content.
+    The file is readable by the owner only."""
+    from threading import current_thread
+    _make_dir(os.path.dirname(path))
+    tmp = '%s.%d.%d.tmp' % (path, os.getpid(), current_thread().ident)
+    try:
+        os.unlink(tmp)          # left by a crashed process
+    except OSError:
+        pass
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, mode) as file:
+        file.write(data)
+    os.rename(tmp, path)
+
+
+@contextmanager
+def file_lock(path):
+    """Hold an exclusive lock of path shared by all processes."""
+    try:
+        import fcntl
+    except ImportError:
+        yield               # no locking
+        return
+    _make_dir(os.path.dirname(path))
+    with open(path + '.lock', 'a') as file:
+        fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+        yield
+
+
+class MailboxCache:
+    """Persisted mailbox lists of IMAP stores.
+
+    An entry is valid as long as the store definition it was fetched for
+    (host, port, user, path and delimiter options) has not changed. A store
+    has an entry for every set of mailbox patterns it was listed with, and
+    a request is served by any entry listed with patterns covering it.
+    Processes watching different stores share the cache file, only updated
+    entries are saved.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(get_cache_dir(), 'mailboxes.json')
+        self.entries = self._read()
+        # (store name, entry) to save
+        self.updated = []
+
+    def _read(self):
+        try:
+            with open(self.path) as file:
+                entries = json.load(file)
+            # skip entries of older versions
+            return dict((stname, store_entries) for stname, store_entries
+                        in entries.items() if isinstance(store_entries, list))
+        except (IOError, OSError):
+            pass
+        except (ValueError, AttributeError) as e:
+            logger.warning("ignoring broken mailbox cache %s: %s",
+                           self.path, e)
+        return {}
+
+    @staticmethod
+    def store_key(store):
+        return [MAILBOX_CACHE_VERSION] + [store.get(option) for option in
+                ('host', 'port', 'user', 'path', 'pathdelimiter',
+                 'subscribedonly')]
+
+    @staticmethod
+    def covers(patterns, requested):
+        """Tell whether mailboxes listed with patterns include all
+        mailboxes matching requested patterns. None means all mailboxes."""
+        return patterns is None or (requested is not None and
+                                    set(requested) <= set(patterns))
+
+    def get(self, stname, key, patterns=None):
+        """Return cached entry for the store listed with patterns or None."""
+        for entry in self.entries.get(stname, []):
+            if entry['key'] == key and \
+                    self.covers(entry['patterns'], patterns):
+                return entry
+
+    @classmethod
+    def _add(cls, store_entries, entry):
+        """Return store_entries with entry replacing stale and covered
+        ones."""
+        return [old for old in store_entries
+                if old['key'] == entry['key'] and
+                not cls.covers(entry['patterns'], old['patterns'])] + [entry]
+
+    def put(self, stname, key, store, patterns=None):
+        entry = {
+            'key': key, 'patterns': patterns, 'time': time.time(),
+            'mailboxes': store['mailboxes'],
+            'delimiter': store.get('delimiter'),
+            'path': store['path']}
+        self.entries[stname] = self._add(self.entries.get(stname, []), entry)
+        self.updated.append((stname, entry))
+
+    def save(self):
+        if not self.updated:
+            return
+        try:
+            with file_lock(self.path):
+                # keep entries saved by other processes meanwhile
+                entries = self._read()
+                for stname, entry in self.updated:
+                    entries[stname] = self._add(entries.get(stname, []),
+                                                entry)
+                write_atomic(self.path, json.dumps(entries, sort_keys=True))
+            self.entries = entries
+            self.updated = []
+        except (IOError, OSError) as e:
+            logger.warning("can't save mailbox cache: %s", e)
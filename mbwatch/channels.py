@@ -47,55 +47,121 @@ def get_channels(args, config):
     return channels
 
 
+def get_store_name(store):
+    return store.get('imapstore') or store['maildirstore']
+
+
+def get_sync_direction(channel, stname):
+    """Return 'pull' if changes of store stname are propagated from master to
+    slave or 'push' otherwise."""
+    return 'pull' if get_store_name(channel['master']) == stname else 'push'
+
+
 def iterate_stores(channels):
     stnames = set()
     for channel in channels.values():
         for store in (channel['master'], channel['slave']):
-            stname = store.get('imapstore') or store['maildirstore']
+            stname = get_store_name(store)
             if stname not in stnames:
                 stnames.add(stname)
                 yield stname, store
 
 
-box_re = re.compile(r'(?P<attr>\(.*\)) +"(?P<delim>.+?)" +"?(?P<name>.+?)"?$')
 ns_re = re.compile(r'NIL|\(\("(?P<prefix>.*)"\ (NIL|"(?P<delim>.)")\)')
 
 
-def populate_stores_w_mailboxes(stores, cpool):
-    """Populate stores with mailboxes, delimiters and passwords"""
+def get_list_patterns(stname, channels):
+    """Return slash-delimited LIST patterns relative to the store path which
+    match every mailbox of store stname the channels may sync, or None if
+    all mailboxes have to be listed."""
+    patterns = set()
+    for channel in channels.values():
+        for stype in ('master', 'slave'):
+            if get_store_name(channel[stype]) != stname:
+                continue
+            prefix = channel[stype + '_box']
+            if 'boxes' in channel:
+                boxes = channel['boxes']
+            elif 'patterns' in channel:
+                # negated patterns only narrow down the listed mailboxes
+                boxes = [p for p in channel['patterns']
+                         if not p.startswith('!')]
+            else:
+                boxes, prefix = [prefix or 'INBOX'], ''
+            for box in boxes:
+                if prefix + box == '*':
+                    return None
+                patterns.add(prefix + box)
+    return sorted(patterns)
+
+
+def _populate_imap_store(store, cpool, user=None, patterns=None):
+    from .imapidle import list_mailboxes
+    passwd = get_password(store, user)
+    store['pass'] = passwd
+    con = cpool.get_or_create_connection(
+        store['host'], store['user'], passwd,
+        store['port'], store['ssltype'])
+    try:
+        try:
+            ns = con.namespace()
+            m = ns_re.match(s(ns[1][0]))
+            if m:
+                prefix, delim = m.group('prefix'), m.group('delim')
+                delim = store.get('pathdelimiter', delim)
+                if delim:
+                    store['delimiter'] = delim
+                store.setdefault('path', prefix or '')
+        except con.error as e:
+            logger.warning('namespace command failed: %s', e)
+            store.setdefault('path', '')
+        if patterns is not None and 'delimiter' in store:
+            patterns = [p if p.upper() == 'INBOX' else
+                        store['path'] + p.replace('/', store['delimiter'])
+                        for p in patterns]
+        else:
+            patterns = ['*']
+        selection = ['SUBSCRIBED'] if store.get('subscribedonly') else None
+        for attr, delim, name in list_mailboxes(con, patterns,
+                                                selection=selection):
+            if '\\Noselect' not in attr and '\\NonExistent' not in attr:
+                if name.startswith(store['path']):
+                    name = name[len(store['path']):]
+                    store['mailboxes'].append(name)
+                    if delim:
+                        store.setdefault('delimiter', delim)
+    finally:
+        cpool.release(con)
+
+
+def populate_stores_w_mailboxes(stores, cpool, cache=None, refresh=True,
+                                user=None, channels=None):
+    """Populate stores with mailboxes, delimiters and passwords.
+
+    If cache is given, IMAP mailbox lists are saved to it. Unless refresh
+    is true, cached lists are used instead of asking the servers, and the
+    stores are not populated with passwords then. Password commands are
+    run as user if given. If channels are given, only mailboxes they may
+    sync are listed.
+    """
     for stname, store in stores.items():
         store['mailboxes'], store['delimiters'] = [], []
         if 'imapstore' in store:
-            passwd = get_password(store)
-            store['pass'] = passwd
-            con = cpool.get_or_create_connection(
-                store['host'], store['user'], passwd,
-                store['port'], store['ssltype'])
-            try:
-                ns = con.namespace()
-                m = ns_re.match(s(ns[1][0]))
-                if m:
-                    prefix, delim = m.group('prefix'), m.group('delim')
-                    delim = store.get('pathdelimiter', delim)
-                    if delim:
-                        store['delimiter'] = delim
-                    store.setdefault('path', prefix or '')
-            except con.error as e:
-                logger.warning('namespace command failed: %s', e)
-                store.setdefault('path', '')
-            resp = con.list()
-            for box in (s(b) for b in resp[1]):
-                m = box_re.match(box)
-                if not m:
-                    cpool.release(con)  # REMOVE
-                    raise con.error("unexpected response from server: %s" % box)
-                if '\\Noselect' not in m.group('attr'):
-                    name = m.group('name')
-                    if name.startswith(store['path']):
-                        name = name[len(store['path']):]
-                        store['mailboxes'].append(name)
-                        store.setdefault('delimiter', m.group('delim'))
-            cpool.release(con)
+            patterns = get_list_patterns(stname, channels) if channels \
+                else None
+            key = cache.store_key(store) if cache else None
+            entry = cache.get(stname, key, patterns) \
+                if cache and not refresh else None
+            if entry:
+                logger.debug("store '%s' mailboxes are cached", stname)
+                store['mailboxes'] = entry['mailboxes']
+                store['path'] = entry['path']
+                if entry['delimiter']:
+                    store['delimiter'] = entry['delimiter']
+            else:
+                _populate_imap_store(store, cpool, user, patterns)
+                if cache:
+                    cache.put(stname, key, store, patterns)
         else:
             store['inbox'] = os.path.expanduser(store['inbox'])
             store['path'] = os.path.expanduser(store['path'])
@@ -108,6 +174,8 @@ def populate_stores_w_mailboxes(stores, cpool):
                         box = os.path.relpath(root, store['path'])
                     store['mailboxes'].append(box)
         logger.debug("store '%s' mailboxes: %s", stname, store['mailboxes'])
+    if cache:
+        cache.save()
 
 
 def pattern_to_regex(pattern, delimiter='/'):
@@ -146,7 +214,7 @@ def get_syncmap(channels):
         pairs = defaultdict(list)
         for stype in ('master', 'slave'):
             store = channel[stype]
-            stname = store.get('imapstore') or store['maildirstore']
+            stname = get_store_name(store)
             prefix = channel[stype + '_box']
             delim = store['delimiter']
             if 'boxes' in channel:
@@ -183,3 +251,21 @@ def get_syncmap(channels):
             syncmap.update({pair[0]: pair[1] + (chname,),
                             pair[1]: pair[0] + (chname,)})
     return syncmap
+
+
+def iterate_channel_boxes(channels, syncmap):
+    """Yield (channel name, mailbox) pairs of the syncmap in channel order.
+    mailbox is None for single box channels.
+    """
+    boxes = defaultdict(set)
+    for (stname, box, path), pair in syncmap.items():
+        chname = pair[-1]
+        channel = channels[chname]
+        if stname == get_store_name(channel['master']):
+            boxes[chname].add(box)
+    for chname, channel in channels.items():
+        if 'boxes' in channel or 'regexps' in channel:
+            for box in sorted(boxes[chname]):
+                yield chname, box
+        else:
+            yield chname, None
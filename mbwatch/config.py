@@ -1,6 +1,17 @@
 from collections import OrderedDict
+import errno
+import hashlib
+import logging
 import os
-import shlex
+
+from .cache import get_cache_dir, write_atomic
+
+
+logger = logging.getLogger(__name__)
+
+# increment when the structure of parsed config changes; 2 replaces caches
+# written readable by everyone
+CONFIG_CACHE_VERSION = 2
 
 
 class ConfigError(Exception):
@@ -13,6 +24,7 @@ class ConfigError(Exception):
 
 
 def _read_config(file):
+    import shlex
     config = {}
     config['group'] = {}
     lno = 0
@@ -80,9 +92,66 @@ def _post_process_config(config):
     return config
 
 
-def read_config(path="~/.mbsyncrc"):
+def _get_cache_path(path):
+    digest = hashlib.sha1(path.encode('utf-8')).hexdigest()
+    return os.path.join(get_cache_dir(), 'config-%s.pickle' % digest)
+
+
+def _load_cached_config(cache_path, key):
+    import pickle
+    try:
+        with open(cache_path, 'rb') as file:
+            cached_key, config = pickle.load(file)
+        if cached_key == key:
+            return config
+    except (IOError, OSError, EOFError, ValueError, TypeError,
+            AttributeError, ImportError, pickle.UnpicklingError) as e:
+        logger.debug("can't load cached config: %s", e)
+
+
+def _save_cached_config(cache_path, key, config):
+    import pickle
+    try:
+        write_atomic(cache_path, pickle.dumps((key, config), 2), 'wb')
+    except (IOError, OSError, pickle.PicklingError) as e:
+        logger.debug("can't cache config: %s", e)
+
+
+def _open_owned(path, owner):
+    """Open path unless it's a symlink or it isn't owned by uid owner."""
+    fd = os.open(path, os.O_RDONLY | getattr(os, 'O_NOFOLLOW', 0))
+    file = os.fdopen(fd)
+    if os.fstat(fd).st_uid != owner:
+        file.close()
+        raise ConfigError("%s is not owned by the user" % path)
+    return file
+
+
+def read_config(path="~/.mbsyncrc", cache=True, owner=None):
+    """Read and post-process config.
+
+    Unless cache is false, the result is cached in the cache directory and
+    reused while the config file's path, mtime, size and inode are the same.
+    If owner uid is given, symlinks and files of other users are refused.
+    """
+    path = os.path.abspath(os.path.expanduser(path))
     try:
-        with open(os.path.expanduser(path)) as file:
-            return _post_process_config(_read_config(file))
-    except IOError as e:
+        with open(path) if owner is None else _open_owned(path, owner) \
+                as file:
+            st = os.fstat(file.fileno())
+            key = (CONFIG_CACHE_VERSION, path,
+                   getattr(st, 'st_mtime_ns', st.st_mtime), st.st_size,
+                   st.st_ino)
+            cache_path = _get_cache_path(path) if cache else None
+            if cache:
+                config = _load_cached_config(cache_path, key)
+                if config is not None:
+                    return config
+            config = _post_process_config(_read_config(file))
+    except (IOError, OSError) as e:
+        if e.errno == errno.ELOOP:
+            raise ConfigError("%s is a symlink" % path)
         raise ConfigError(e)
+    if cache:
+        _save_cached_config(cache_path, key, config)
+    return config
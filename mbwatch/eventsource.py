@@ -0,0 +1,93 @@
+"""Mailbox change notifications delivered for many mailboxes over a single
+connection, as an alternative to an IMAP IDLE connection per mailbox."""
+
+import logging
+import socket
+from threading import Event, Thread
+import time
+
+from .util import Backoff
+
+
+logger = logging.getLogger(__name__)
+
+
+class EventSourceError(Exception):
+    """Error which reconnecting won't fix, e.g. failed authentication."""
+
+
+class EventSource:
+    """Watch several mailboxes of a store over one connection.
+
+    callbacks is a dict {mailbox path: callback(received)}. Subclasses
+    implement listen(), which connects to the server and calls notify() for
+    every changed mailbox until the connection is closed. Then the source
+    reconnects with exponential backoff. EventSourceError and unexpected
+    exceptions are passed to on_error(e), which is called from the except
+    clause, and stop the source.
+    """
+
+    def __init__(self, name, callbacks, on_error, stop=None):
+        self.name = name
+        self.callbacks = callbacks
+        self.on_error = on_error
+        self.stop = stop or Event()
+
+    def notify(self, path, received=None):
+        callback = self.callbacks.get(path)
+        if callback:
+            callback(received)
+        else:
+            logger.debug("%s: %s is not watched", self.name, path)
+
+    def notify_all(self, received=None):
+        for callback in self.callbacks.values():
+            callback(received)
+
+    def start(self):
+        t = Thread(target=self.run, name=self.name)
+        t.daemon = True
+        t.start()
+
+    def run(self):
+        backoff = Backoff()
+        while not self.stop.is_set():
+            started = time.time()
+            try:
+                self.listen()
+            except EventSourceError as e:
+                self.on_error(e)
+                return
+            except (IOError, OSError, socket.error, ValueError, KeyError) as e:
+                logger.error("%s: %s", self.name, e,
+                             exc_info=logger.isEnabledFor(logging.DEBUG))
+            except Exception as e:
+                self.on_error(e)
+                return
+            delay = backoff.next(started)
+            logger.debug("%s: reconnect in %ds", self.name, delay)
+            self.stop.wait(delay)
+
+    def listen(self):
+        raise NotImplementedError
+
+
+def iter_sse(lines):
+    """Yield (event, data) of Server-Sent Events read from byte lines."""
+    event, data = None, []
+    for line in lines:
+        line = line.decode('utf-8').rstrip('\r\n')
+        if not line:
+            if data:
+                yield event or 'message', '\n'.join(data)
+            event, data = None, []
+            continue
+        if line.startswith(':'):
+            continue            # comment
+        field, _, value = line.partition(':')
+        if value.startswith(' '):
+            value = value[1:]
+        if field == 'event':
+            event = value
+        elif field == 'data':
+            data.append(value)
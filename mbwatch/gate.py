@@ -0,0 +1,57 @@
+"""Control over which mailboxes may hold an IDLE connection."""
+
+from collections import defaultdict
+from threading import Condition
+
+
+class WatchGate:
+    """Let mailbox watchers IDLE only while they are not blocked.
+
+    A mailbox may be blocked for several reasons at once (e.g. low-power
+    mode, rare activity) and is open again once all of them are lifted.
+    Blocking a mailbox shuts down the socket of its watcher, which makes
+    the watcher return to wait() until the mailbox is open again.
+    """
+
+    def __init__(self):
+        self.cond = Condition()
+        # key -> set of reasons
+        self.blocked = defaultdict(set)
+        self.cons = {}
+
+    def is_blocked(self, key):
+        with self.cond:
+            return bool(self.blocked.get(key))
+
+    def block(self, keys, reason):
+        from .imapidle import interrupt
+        cons = []
+        with self.cond:
+            for key in keys:
+                if not self.blocked[key] and key in self.cons:
+                    cons.append(self.cons.pop(key))
+                self.blocked[key].add(reason)
+        for con in cons:
+            interrupt(con)
+
+    def unblock(self, keys, reason):
+        with self.cond:
+            for key in keys:
+                self.blocked[key].discard(reason)
+            self.cond.notify_all()
+
+    def wait(self, key):
+        """Block while IDLE is not allowed for key."""
+        with self.cond:
+            while self.blocked.get(key):
+                self.cond.wait()
+
+    def register(self, key, con):
+        """Remember connection watching key, so it can be interrupted."""
+        with self.cond:
+            if not self.blocked.get(key):
+                self.cons[key] = con
+                return
+        from .imapidle import interrupt
+        interrupt(con)
+
@@ -1,10 +1,12 @@
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
 from functools import wraps
 import logging
 import imaplib
+import re
 import socket
 import ssl
-from threading import RLock
+from threading import RLock, Thread
+import time
 
 from .six import b, s, string_types, PY3
 
@@ -102,6 +104,7 @@ def _logout(con):
 
 
 def idle(con, timeout=29*60):
+    """Yield the time of every EXISTS response received while idling."""
     con.sock.settimeout(timeout)
     while True:
         tag = s(con._new_tag())
@@ -116,6 +119,7 @@ def idle(con, timeout=29*60):
                                 (token, resp, text))
             if resp in ('NO', 'BAD'):
                 raise con.abort('idle is not known or allowed')
+        received = time.time()
         # wait for '* <X> EXISTS' response
         if token == '+' and text != 'EXISTS':
             while True:
@@ -124,6 +128,7 @@ def idle(con, timeout=29*60):
                 except IMAPTimeout:
                     break
                 if text == 'EXISTS':
+                    received = time.time()
                     break
         _send(con, 'DONE')
         con.idling = False
@@ -136,21 +141,145 @@ def idle(con, timeout=29*60):
                 else:
                     raise con.abort('idle failed: %s %s %s' % (tk, ok, txt))
         if text == 'EXISTS':
-            yield
+            yield received
 
 
 def watch(con, mailbox, callback):
     if 'IDLE' in con.capabilities:
         con.select(con._quote(mailbox), True)
         try:
-            for m in idle(con):
-                callback()
+            for received in idle(con):
+                callback(received)
         except StopIdle:
             logger.debug("watch loop stopped")
     else:
         raise con.abort("idle is not supported")
 
 
+# the name is a quoted string, a literal or an atom; RFC 5258 extended data
+# may follow it
+list_re = re.compile(r'\* (?:LIST|LSUB) \((?P<attr>[^)]*)\) '
+                     r'(?:"(?P<delim>(?:\\.|[^"])*)"|NIL) '
+                     r'(?P<name>"(?:\\.|[^"\\])*"|\{\d+\+?\}|[^ ]+)'
+                     r'(?: .*)?$')
+literal_re = re.compile(r'\{(\d+)\+?\}$')
+
+
+def _quote_list_arg(arg):
+    return '"%s"' % arg.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def _unescape(quoted):
+    """Return content of a quoted string without the escapes."""
+    return re.sub(r'\\(.)', r'\1', quoted)
+
+
+def _read_list_name(con, rest):
+    """Parse mailbox name from the rest of LIST response line reading
+    the literal from the connection if needed."""
+    m = literal_re.match(rest)
+    if m:
+        name = s(con.read(int(m.group(1))))
+        con._get_line()             # the empty remainder of the response
+        return name
+    if rest.startswith('"'):
+        return _unescape(rest[1:-1])
+    return rest
+
+
+def list_mailboxes(con, patterns=('*',), reference='', selection=None):
+    """Send LIST command and yield (attributes, delimiter, name) of every
+    mailbox as soon as it's received.
+
+    Several patterns are sent in a single command (RFC 5258) if the server
+    supports LIST-EXTENDED, otherwise a command per pattern is sent and
+    duplicates are skipped. selection is a list of RFC 5258 selection
+    options, e.g. ['SUBSCRIBED']; without LIST-EXTENDED LSUB is used for
+    subscribed mailboxes instead.
+    """
+    extended = 'LIST-EXTENDED' in con.capabilities
+    if selection and not extended:
+        if selection != ['SUBSCRIBED']:
+            raise con.error('LIST selection options are not supported')
+        command, selection = 'LSUB', None
+    else:
+        command = 'LIST'
+    if extended and len(patterns) > 1:
+        commands = [' '.join(_quote_list_arg(p) for p in patterns)]
+        commands[0] = '(%s)' % commands[0]
+    else:
+        commands = [_quote_list_arg(p) for p in patterns]
+    seen = set()
+    for pattern in commands:
+        tag = s(con._new_tag())
+        args = [command]
+        if selection:
+            args.append('(%s)' % ' '.join(selection))
+        args += [_quote_list_arg(reference), pattern]
+        _send_simple(con, '%s %s' % (tag, ' '.join(args)))
+        try:
+            while True:
+                line = s(con._get_line())
+                if line.startswith(tag + ' '):
+                    if line.split(None, 2)[1] != 'OK':
+                        raise con.error('%s failed: %s' % (command, line))
+                    break
+                m = list_re.match(line)
+                if not m:
+                    continue        # other untagged responses
+                name = _read_list_name(con, m.group('name'))
+                if name not in seen:
+                    if len(commands) > 1:
+                        seen.add(name)
+                    delim = m.group('delim')
+                    if delim is not None:
+                        delim = _unescape(delim)
+                    yield m.group('attr'), delim, name
+        finally:
+            con.tagged_commands.pop(b(tag) if PY3 else tag, None)
+
+
+status_re = re.compile(r'\* STATUS (?P<name>.*) \((?P<items>[^()]*)\)$')
+
+
+def status_mailboxes(con, mailboxes,
+                     items=('MESSAGES', 'UIDNEXT', 'UIDVALIDITY')):
+    """Send STATUS commands for all mailboxes at once and yield (mailbox,
+    {item: value}) as responses arrive, or (mailbox, None) if STATUS of the
+    mailbox failed. Pipelined commands cost a single round trip."""
+    tags = dict((s(con._new_tag()), mailbox) for mailbox in mailboxes)
+    _send_simple(con, '\r\n'.join(
+        '%s STATUS %s (%s)' % (tag, _quote_list_arg(mailbox), ' '.join(items))
+        for tag, mailbox in tags.items()))
+    pending = set(tags)
+    try:
+        while pending:
+            line = s(con._get_line())
+            tag = line.split(' ', 1)[0]
+            if tag in pending:
+                pending.discard(tag)
+                if line.split(None, 2)[1] != 'OK':
+                    logger.debug('STATUS %s failed: %s', tags[tag], line)
+                    yield tags[tag], None
+                continue
+            if not line.startswith('* STATUS '):
+                continue        # other untagged responses
+            literal = literal_re.search(line)
+            if literal:
+                name = s(con.read(int(literal.group(1))))
+                line = '* STATUS "" ' + s(con._get_line()).lstrip()
+            m = status_re.match(line)
+            if not m:
+                raise con.abort('unexpected response: %s' % line)
+            if not literal:
+                name = _read_list_name(con, m.group('name'))
+            values = m.group('items').split()
+            yield name, dict(zip(values[::2], values[1::2]))
+    finally:
+        for tag in tags:
+            con.tagged_commands.pop(b(tag) if PY3 else tag, None)
+
+
 def starttls(con, ssl_context=None):
     """Python3's imaplib starttls port for Python2."""
     name = 'STARTTLS'
@@ -179,46 +308,86 @@ def starttls(con, ssl_context=None):
         raise con.error("Couldn't establish TLS session")
 
 
+def interrupt(con):
+    """Shut down the socket of con, so that a thread reading from it gets
+    EOF."""
+    try:
+        # not SSLSocket.shutdown: it resets SSL state which may be in use by
+        # a thread reading from the socket
+        socket.socket.shutdown(con.sock, socket.SHUT_RDWR)
+    except (socket.error, OSError) as e:
+        logger.debug("error on interrupting the connection: %s", e)
+
+
 class ConnectionPool:
+    """Pool of logged in IMAP connections keyed by (host, port, user).
+
+    Every connection is either busy (checked out) or released. Released
+    connections beyond the number of warm spares are logged out after
+    max_idle seconds, spares are kept alive with NOOP every keepalive
+    seconds and are preferred over new logins when reconnecting.
+    """
 
-    _busy = defaultdict(list)
-    _released = defaultdict(list)
-    _con_key_map = {}
+    max_idle = 300
+    keepalive = 240
+    spares = 1
 
-    def __init__(self, debug=False):
+    def __init__(self, debug=False, namespace=None):
         self.debug = 4 if debug else 0
+        # only used to tell pools apart in logs
+        self.namespace = namespace
         self.lock = RLock()
+        self._busy = defaultdict(set)
+        # key -> OrderedDict {con: time of release}, most recent last
+        self._released = defaultdict(OrderedDict)
+        self._con_key_map = {}
+        self._stats = defaultdict(int)
 
     def get_or_create_connection(self, host, user, password, port=143,
                                  ssltype='STARTTLS'):
         key = (host, port, user)
         # get free connection if available
-        with self.lock:
-            if self._released.get(key):
-                imap = self._released[key].pop()
-                self._busy[key].append(imap)
-                return imap
+        imap = self._checkout(key)
+        if imap is not None:
+            return imap
         # otherwise create new
         imap = self._connect(host, port, user, password, ssltype)
         self._add_connection(imap, key)
         return imap
 
     def reconnect(self, con, password, ssltype):
-        key = self._con_key_map[con]
-        host, port, user = key
-        imap = self._connect(host, port, user, password, ssltype)
+        """Replace broken connection con with a warm spare or a new one."""
+        key = con.pool_key
+        self._remove_connection(con)
         with self.lock:
+            self._stats['reconnects'] += 1
+        imap = self._checkout(key)
+        if imap is None:
+            host, port, user = key
+            imap = self._connect(host, port, user, password, ssltype)
             self._add_connection(imap, key)
-            self._remove_connection(con)
         return imap
 
     def release(self, con):
         with self.lock:
-            key = self._con_key_map[con]
-            self._released[key].append(self._busy[key].pop())
+            key = self._con_key_map.get(con)
+            if key is None:
+                return          # removed meanwhile
+            self._busy[key].discard(con)
+            self._released[key][con] = time.time()
 
     def count(self):
-        return len(self._con_key_map)
+        with self.lock:
+            return len(self._con_key_map)
+
+    def stats(self):
+        """Return counters of pool events and current connection numbers."""
+        with self.lock:
+            stats = dict(self._stats)
+            stats['busy'] = sum(len(cons) for cons in self._busy.values())
+            stats['released'] = sum(len(cons)
+                                    for cons in self._released.values())
+            return stats
 
     def close(self, con):
         # avoid long locks in case of errors
@@ -232,9 +401,94 @@ class ConnectionPool:
             logger.error("error on shutting down the connection %s ", e)
         self._remove_connection(con)
 
+    def discard(self, con):
+        """Remove con, e.g. an interrupted one, from the pool and close it
+        without logging out."""
+        self._remove_connection(con)
+        try:
+            con.shutdown()
+        except (socket.error, OSError) as e:
+            logger.debug("error on closing the connection: %s", e)
+
+    def interrupt_all(self):
+        """Drop all connections after network change.
+
+        Released connections are discarded. Sockets of busy connections are
+        shut down, so their users get EOF and reconnect.
+        """
+        with self.lock:
+            released = [con for cons in self._released.values()
+                        for con in cons]
+            busy = [con for cons in self._busy.values() for con in cons]
+            for con in released:
+                self._remove_connection(con)
+        for con in released + busy:
+            interrupt(con)
+        for con in released:
+            con.sock.close()
+
     def close_all(self):
-        for con in list(self._con_key_map):
+        with self.lock:
+            cons = list(self._con_key_map)
+        for con in cons:
+            self.close(con)
+
+    def maintain(self):
+        """Evict idle connections and send NOOP to warm spares."""
+        now = time.time()
+        evict, ping = [], []
+        with self.lock:
+            for key, cons in self._released.items():
+                # the most recently released connections are kept as spares
+                for i, (con, released) in enumerate(reversed(cons.items())):
+                    if i >= self.spares and now - released > self.max_idle:
+                        evict.append(con)
+                    elif i < self.spares and now - released > self.keepalive:
+                        ping.append(con)
+            for con in evict + ping:
+                self._released[con.pool_key].pop(con)
+                self._busy[con.pool_key].add(con)
+            self._stats['evicted'] += len(evict)
+        for con in evict:
+            logger.debug("closing idle connection to %s", con.host)
             self.close(con)
+        for con in ping:
+            try:
+                con.noop()
+            except (imaplib.IMAP4.error, socket.error, OSError) as e:
+                logger.debug("keepalive failed: %s", e)
+                with self.lock:
+                    self._stats['keepalive_failures'] += 1
+                self._remove_connection(con)
+                try:
+                    con.shutdown()
+                except (socket.error, OSError):
+                    pass
+            else:
+                with self.lock:
+                    self._stats['keepalives'] += 1
+                self.release(con)
+
+    def start_maintenance(self, stop, interval=60):
+        """Run maintain every interval seconds until stop event is set."""
+
+        def run():
+            while not stop.wait(interval):
+                self.maintain()
+                logger.debug("connection pool %s: %s",
+                             self.namespace or '', self.stats())
+
+        t = Thread(target=run, name='pool-maintenance')
+        t.daemon = True
+        t.start()
+
+    def _checkout(self, key):
+        with self.lock:
+            if self._released.get(key):
+                imap, _ = self._released[key].popitem()
+                self._busy[key].add(imap)
+                self._stats['reused'] += 1
+                return imap
 
     def _connect(self, host, port, user, password, ssltype):
         if ssltype == 'STARTTLS':
@@ -255,14 +509,16 @@ class ConnectionPool:
 
     def _add_connection(self, con, key):
         with self.lock:
-            self._busy[key].append(con)
+            con.pool_key = key
+            self._busy[key].add(con)
             self._con_key_map[con] = key
+            self._stats['created'] += 1
 
     def _remove_connection(self, con):
         with self.lock:
-            key = self._con_key_map[con]
-            if con in self._released[key]:
-                self._released[key].remove(con)
-            elif con in self._busy[key]:
-                self._busy[key].remove(con)
-            del self._con_key_map[con]
+            key = self._con_key_map.pop(con, None)
+            if key is None:
+                return
+            self._released[key].pop(con, None)
+            self._busy[key].discard(con)
+            self._stats['removed'] += 1
@@ -0,0 +1,166 @@
+"""JMAP push (RFC 8620 section 7.3) as a source of mailbox changes."""
+
+import base64
+import json
+import logging
+import time
+try:
+    from urllib.error import HTTPError
+    from urllib.parse import urljoin
+    from urllib.request import Request, urlopen
+except ImportError:
+    from urllib2 import HTTPError, Request, urlopen
+    from urlparse import urljoin
+
+from .eventsource import EventSource, EventSourceError, iter_sse
+
+
+logger = logging.getLogger(__name__)
+
+USING = ['urn:ietf:params:jmap:core', 'urn:ietf:params:jmap:mail']
+MAIL_CAPABILITY = 'urn:ietf:params:jmap:mail'
+
+
+class JMAPEventSource(EventSource):
+    """Watch mailboxes of a store with JMAP push.
+
+    url is the JMAP session resource of the account. Mailbox names are
+    joined with delimiter into the IMAP paths used as callbacks keys, the
+    mailbox with inbox role is INBOX. Paths other than INBOX are given the
+    namespace prefix unless they already start with it. The server is asked
+    for Mailbox state changes only: messages arriving, being expunged or
+    read change the counts of their mailbox, and Mailbox/changes tells which
+    mailboxes have changed.
+    """
+
+    # seconds between keepalive events requested from the server; the
+    # stream is considered broken after twice that time without events
+    ping = 60
+    # seconds to wait for responses of API requests
+    timeout = 30
+
+    def __init__(self, url, user, password, callbacks, on_error,
+                 delimiter='/', prefix='', stop=None):
+        EventSource.__init__(self, 'jmap-%s' % user, callbacks, on_error,
+                             stop)
+        self.url = url
+        self.auth = 'Basic ' + base64.b64encode(
+            ('%s:%s' % (user, password)).encode('utf-8')).decode('ascii')
+        self.delimiter = delimiter
+        self.prefix = prefix
+        self.api_url = None
+        self.account = None
+        # mailbox id -> IMAP path
+        self.paths = {}
+        self.state = None
+
+    def _request(self, url, body=None, accept='application/json',
+                 timeout=None):
+        headers = {'Authorization': self.auth, 'Accept': accept}
+        data = None
+        if body is not None:
+            data = json.dumps(body).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        try:
+            return urlopen(Request(url, data, headers),
+                           timeout=timeout or self.timeout)
+        except HTTPError as e:
+            if e.code in (401, 403):
+                raise EventSourceError("%s: access denied (%d)" %
+                                       (url, e.code))
+            raise
+
+    def _get_json(self, url, body=None):
+        resp = self._request(url, body)
+        try:
+            return json.loads(resp.read().decode('utf-8'))
+        finally:
+            resp.close()
+
+    def _call(self, method, args):
+        """Call JMAP method and return (response name, arguments)."""
+        args = dict(args, accountId=self.account)
+        resp = self._get_json(self.api_url, {
+            'using': USING, 'methodCalls': [[method, args, '0']]})
+        name, result, _ = resp['methodResponses'][0]
+        return name, result
+
+    def load_mailboxes(self):
+        name, result = self._call('Mailbox/get', {
+            'ids': None, 'properties': ['name', 'parentId', 'role']})
+        if name == 'error':
+            raise ValueError("Mailbox/get failed: %s" % result.get('type'))
+        boxes = dict((box['id'], box) for box in result['list'])
+        self.paths = {}
+        for boxid, box in boxes.items():
+            names = []
+            while box is not None:
+                names.insert(0, 'INBOX' if box.get('role') == 'inbox'
+                             else box['name'])
+                box = boxes.get(box.get('parentId'))
+            path = self.delimiter.join(names)
+            if path != 'INBOX' and not path.startswith(self.prefix):
+                path = self.prefix + path
+            self.paths[boxid] = path
+        self.state = result['state']
+        logger.debug("%s: %d mailboxes, state %s",
+                     self.name, len(self.paths), self.state)
+
+    def fetch_changes(self):
+        """Notify about mailboxes changed since the known state."""
+        received = time.time()
+        while True:
+            name, result = self._call('Mailbox/changes',
+                                      {'sinceState': self.state})
+            if name == 'error':
+                if result.get('type') != 'cannotCalculateChanges':
+                    raise ValueError("Mailbox/changes failed: %s" %
+                                     result.get('type'))
+                logger.info("%s: changes are lost, syncing all mailboxes",
+                            self.name)
+                self.load_mailboxes()
+                self.notify_all(received)
+                return
+            if result['created'] or result['destroyed']:
+                logger.info("%s: mailboxes created or destroyed, restart "
+                            "to watch them", self.name)
+                self.load_mailboxes()
+            for boxid in result['created'] + result['updated']:
+                if boxid in self.paths:
+                    self.notify(self.paths[boxid], received)
+            self.state = result['newState']
+            if not result.get('hasMoreChanges'):
+                break
+
+    def get_event_source_url(self, template):
+        for name, value in (('types', 'Mailbox'), ('closeafter', 'no'),
+                            ('ping', str(self.ping))):
+            template = template.replace('{%s}' % name, value)
+        return urljoin(self.url, template)
+
+    def listen(self):
+        session = self._get_json(self.url)
+        self.api_url = urljoin(self.url, session['apiUrl'])
+        self.account = session['primaryAccounts'][MAIL_CAPABILITY]
+        url = self.get_event_source_url(session['eventSourceUrl'])
+        resp = self._request(url, accept='text/event-stream',
+                             timeout=2 * self.ping)
+        logger.debug("%s: listening to %s", self.name, url)
+        try:
+            # get the state after subscribing, so no change is missed
+            if self.state is None:
+                self.load_mailboxes()
+            else:
+                self.fetch_changes()    # changes missed while disconnected
+            for event, data in iter_sse(resp):
+                if self.stop.is_set():
+                    break
+                if event != 'state':
+                    continue        # ping
+                changed = json.loads(data).get('changed', {})
+                state = changed.get(self.account, {}).get('Mailbox')
+                if state and state != self.state:
+                    self.fetch_changes()
+        finally:
+            resp.close()
+        logger.debug("%s: event stream closed", self.name)
@@ -0,0 +1,133 @@
+from collections import OrderedDict
+import json
+import logging
+import os
+from threading import RLock
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+logger = logging.getLogger(__name__)
+
+
+class SyncJournal:
+    """Append-only on-disk journal of pending mailbox syncs.
+
+    A record is appended and fsynced only when a mailbox becomes pending or
+    its sync source changes, so bursts of events for the same mailbox cost
+    a single write. Completed syncs are appended without fsync: losing them
+    means a redundant sync after a crash, not a lost one. When the journal
+    grows over max_records it is compacted to the pending records only.
+    """
+
+    def __init__(self, path, max_records=1000):
+        self.path = os.path.expanduser(path)
+        self.max_records = max_records
+        self.lock = RLock()
+        # (storename, mailbox, path) -> [source, number of queued tasks]
+        self.pending = OrderedDict()
+        self.records = 0
+        self.existed = os.path.exists(self.path)
+        if self.existed:
+            self._load()
+        self.file = open(self.path, 'a')
+        self.compact()
+
+    def _load(self):
+        with open(self.path) as file:
+            for line in file:
+                try:
+                    rec = json.loads(line)
+                    pair = tuple(rec['pair'])
+                except (ValueError, KeyError, TypeError):
+                    # a record torn by a crash
+                    logger.warning("ignoring broken journal record: %r", line)
+                    continue
+                if rec.get('op') == 'add':
+                    self.pending[pair] = [rec.get('source'), 0]
+                else:
+                    self.pending.pop(pair, None)
+        logger.debug("journal %s: %d pending syncs",
+                     self.path, len(self.pending))
+
+    def _write(self, op, pair, source=None):
+        rec = {'op': op, 'pair': list(pair)}
+        if op == 'add':
+            rec['source'] = source
+        self.file.write(json.dumps(rec) + '\n')
+        self.records += 1
+
+    def outstanding(self):
+        """Return pending syncs as a list of (syncpair, source)."""
+        with self.lock:
+            return [(pair, source)
+                    for pair, (source, _) in self.pending.items()]
+
+    def add(self, pairs, source):
+        with self.lock:
+            written = False
+            for pair in pairs:
+                entry = self.pending.get(pair)
+                if entry is None:
+                    self.pending[pair] = entry = [source, 0]
+                    self._write('add', pair, source)
+                    written = True
+                elif entry[0] is not None and entry[0] != source:
+                    # different changes on both sides need a full sync
+                    entry[0] = None
+                    self._write('add', pair, None)
+                    written = True
+                entry[1] += 1
+            if written:
+                self.file.flush()
+                os.fsync(self.file.fileno())
+
+    def done(self, pairs):
+        with self.lock:
+            for pair in pairs:
+                entry = self.pending.get(pair)
+                if entry is None:
+                    continue
+                entry[1] -= 1
+                if entry[1] <= 0:
+                    del self.pending[pair]
+                    self._write('done', pair)
+            self.file.flush()
+            if self.records > max(self.max_records, 2 * len(self.pending)):
+                self.compact()
+
+    def compact(self):
+        """Rewrite the journal to contain pending syncs only."""
+        with self.lock:
+            tmp = '%s.tmp' % self.path
+            with open(tmp, 'w') as file:
+                for pair, (source, _) in self.pending.items():
+                    file.write(json.dumps({'op': 'add', 'pair': list(pair),
+                                           'source': source}) + '\n')
+                file.flush()
+                os.fsync(file.fileno())
+            os.rename(tmp, self.path)
+            self.file.close()
+            self.file = open(self.path, 'a')
+            self.records = len(self.pending)
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+class JournaledQueue(queue.Queue):
+    """Task queue recording queued SyncTasks in a SyncJournal."""
+
+    def __init__(self, journal, maxsize=0):
+        queue.Queue.__init__(self, maxsize)
+        self.journal = journal
+
+    def put(self, item, block=True, timeout=None):
+        # other tasks have no syncpairs
+        if getattr(item, 'syncpairs', None) and not item.journaled:
+            self.journal.add(item.syncpairs, item.source)
+            item.journaled = True
+        queue.Queue.put(self, item, block, timeout)
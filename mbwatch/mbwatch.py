@@ -1,32 +1,67 @@
 #!/usr/bin/env python
 
-from collections import defaultdict
-from imaplib import IMAP4
+from collections import OrderedDict
 import logging
-import subprocess
-import socket
 import time
 import os
 import signal
 import sys
-import ssl
 try:
     import queue
 except ImportError:
     import Queue as queue
-from threading import Thread
+from threading import Event, Thread
 
 from .arguments import get_arguments, print_help, print_version
-from .channels import (get_channels, get_syncmap, iterate_stores,
-                       populate_stores_w_mailboxes, ChannelError, MailboxError)
+from .cache import MailboxCache, get_cache_dir
+from .channels import (get_channels, get_sync_direction, get_syncmap,
+                       iterate_channel_boxes, iterate_stores,
+                       populate_stores_w_mailboxes, ChannelError,
+                       MailboxError)
 from .config import read_config, ConfigError
-from .imapidle import ConnectionPool, IMAPTimeout, watch
-from .util import PasswordError, res_init
+from .gate import WatchGate
+from .journal import JournaledQueue, SyncJournal
+from .power import PowerManager, PowerPolicy, get_priority_pairs, \
+    write_control
+from .profiling import SignalProfiler
+from .six import PY3
+from .tenants import Tenant, TenantRunner
+from .tiering import ColdPoller, MailboxTiers, TierPolicy
+from . import tracing
+from .util import PasswordError, demote, get_user_env, get_user_ids, \
+    res_init
+
+# Networking, subprocess and multiprocessing modules are imported where they
+# are needed, so that short-lived invocations (--help, --list) start fast.
 
 
 logger = logging.getLogger(__name__)
 
 
+def get_fatal_errors():
+    """Return exceptions which stop watching."""
+    from imaplib import IMAP4
+    import subprocess
+    return (IMAP4.error, PasswordError, MailboxError,
+            subprocess.CalledProcessError)
+
+
+class Terminate(Exception):
+    pass
+
+
+def terminate_handler(signum, frame):
+    raise Terminate("signal %s" % signum)
+
+
+def terminate_once_handler(signum, frame):
+    """Like terminate_handler, but ignore further signals, so cleaning up
+    isn't interrupted when the process group and the supervisor both
+    terminate a worker."""
+    signal.signal(signum, signal.SIG_IGN)
+    raise Terminate("signal %s" % signum)
+
+
 class Task:
     """Base class for all tasks."""
 
@@ -42,45 +77,126 @@ class ErrorTask(Task):
 class SyncTask(Task):
     """Run sync command task."""
 
-    def __init__(self, syncpairs):
-        """synpairs is a list of (storename, mailbox, path) tuples to sync."""
+    # give up syncing after that many timeouts
+    max_attempts = 3
+
+    def __init__(self, syncpairs, trace_ids=(), source=None, window=False):
+        """synpairs is a list of (storename, mailbox, path) tuples to sync.
+        trace_ids are correlation ids of the events which caused the sync.
+        source is 'idle' if new messages appeared in the stores, 'jmap' if
+        the stores' mailboxes changed in any way, 'local' if the maildirs
+        changed or None if the mailboxes must be fully synced.
+        window is true for tasks which must not be deferred to the next
+        low-power window.
+        """
         self.syncpairs = syncpairs
+        self.trace_ids = list(trace_ids)
+        self.source = source
+        self.window = window
+        self.attempts = 0
+        # set by JournaledQueue when the syncs are recorded in the journal
+        self.journaled = False
+        # made of deferred tasks by merge_sync_tasks
+        self.merged = False
+        # pairs to mark done in the journal after the sync, a pair once for
+        # every task merged into this one
+        self.journal_pairs = syncpairs
 
 
 class LocalMailTask(Task):
     """Check file changes in maildirs."""
 
 
-def get_watch_callback(tasks, stname, mailbox, path):
-
-    def callback(tasks=tasks, stname=stname, mailbox=mailbox):
-        tasks.put_nowait(SyncTask([(stname, mailbox, path)]))
+def merge_sync_tasks(tasks):
+    """Return as few SyncTasks as possible doing syncs of tasks. They are
+    already journaled and must not be deferred again."""
+    sources, counts, trace_ids = OrderedDict(), {}, OrderedDict()
+    for task in tasks:
+        for pair in task.syncpairs:
+            if sources.get(pair, task.source) != task.source:
+                sources[pair] = None
+            else:
+                sources[pair] = task.source
+            counts[pair] = counts.get(pair, 0) + 1
+        if task.syncpairs:
+            trace_ids.setdefault(task.syncpairs[0], []).extend(
+                task.trace_ids)
+    groups = OrderedDict()
+    for pair, source in sources.items():
+        groups.setdefault(source, []).append(pair)
+    merged = []
+    for source, pairs in groups.items():
+        task = SyncTask(pairs, [cid for pair in pairs
+                                for cid in trace_ids.get(pair, [])], source,
+                        window=True)
+        task.journaled = task.merged = True
+        task.journal_pairs = [pair for pair in pairs
+                              for _ in range(counts[pair])]
+        merged.append(task)
+    return merged
+
+
+def get_watch_callback(tasks, stname, mailbox, path, power=None, tiers=None,
+                       source='idle'):
+
+    def callback(received=None, tasks=tasks, stname=stname, mailbox=mailbox):
+        if power:
+            power.wakeup(source)
+        if tiers:
+            tiers.event((stname, mailbox, path))
+        cid = tracing.new_id()
+        tracing.record(cid, 'event', received, source=source, store=stname,
+                       mailbox=mailbox)
+        # before putting, the task loop may record dequeue immediately
+        tracing.record(cid, 'enqueue')
+        tasks.put_nowait(SyncTask([(stname, mailbox, path)], [cid], source))
 
     return callback
 
 
-def watch_errors(makecon, mailbox, callback, tasks):
+def watch_errors(makecon, mailbox, callback, tasks, gate=None, key=None,
+                 discard=None):
+    """Watch mailbox with connections made by makecon(old connection).
+    While key is blocked in gate, its connection is closed with
+    discard(connection)."""
+    from imaplib import IMAP4
+    import socket
+    import ssl
+    from .imapidle import IMAPTimeout, watch
 
     def errortask(e):
         tasks.put_nowait(ErrorTask(e, exc_info=sys.exc_info()))
 
     con = None
     while True:
+        if gate:
+            gate.wait(key)
         connected = False
         try:
             con = makecon(con)
             connected = True
+            if gate:
+                gate.register(key, con)
             watch(con, mailbox, callback)
         except (ssl.SSLError, socket.error, IMAP4.abort, IMAPTimeout) as e:
-            logger.log(logging.DEBUG if con.terminating else logging.ERROR,
+            if gate and gate.is_blocked(key):
+                logger.debug('%s: IDLE stopped', mailbox)
+                if con is not None:
+                    discard(con)
+                    con = None      # get a new one when unblocked
+                continue
+            terminating = con is not None and con.terminating
+            logger.log(logging.DEBUG if terminating else logging.ERROR,
                        '%s: %s', type(e), e,
                        exc_info=logger.isEnabledFor(logging.DEBUG))
-            if con.terminating:
+            if terminating:
                 break
             if con and isinstance(e, con.abort) and 'EOF' not in e.args[0]:
                 errortask(e)
                 break
-            if isinstance(e, socket.gaierror) and e.errno == socket.EAI_NONAME:
+            if con is not None or (isinstance(e, socket.gaierror) and
+                                   e.errno == socket.EAI_NONAME):
+                # resolver state is per thread, network might have changed
                 res = res_init()
                 logger.debug('res_init: %d', res)
             if not connected:
@@ -93,17 +209,43 @@ def watch_errors(makecon, mailbox, callback, tasks):
             break               # watch was stopped
 
 
-def watch_local(tasks, period=60):
-    while True:
-        time.sleep(period)
+def watch_local(tasks, period=60, stop=None, power=None):
+    stop = stop or Event()
+    while not stop.wait(power.poll_delay(period) if power else period):
+        if power:
+            power.wakeup('scan')
         tasks.put_nowait(LocalMailTask())
 
 
-def start_watching(tasks, syncmap, stores, cpool, period=60):
+def start_jmap_watching(tasks, store, callbacks, stop=None):
+    """Watch mailboxes of store given by {path: callback} with JMAP push
+    instead of IMAP IDLE."""
+    from .jmap import JMAPEventSource
+
+    def errortask(e):
+        tasks.put_nowait(ErrorTask(e, exc_info=sys.exc_info()))
+
+    JMAPEventSource(store['jmapurl'], store['user'], store['pass'],
+                    callbacks, errortask, store.get('delimiter', '/'),
+                    store.get('path', ''), stop).start()
+
+
+def start_watching(tasks, syncmap, stores, cpool, period=60, stop=None,
+                   gate=None, power=None, tiers=None):
+    """Start watching mailboxes of syncmap. Return {key: callback} of the
+    mailboxes watched with IDLE."""
+    callbacks = {}
+    # stores watched with JMAP push: {store name: {path: callback}}
+    jmap_callbacks = OrderedDict()
     # for imap stores run threads tracking remote mailboxes
     for stname, box, path in syncmap:
         store = stores[stname]
-        if 'imapstore' in store:
+        if 'jmapurl' in store:
+            # expunges and read messages change the mailbox state too, so
+            # the sync isn't limited to new messages
+            jmap_callbacks.setdefault(stname, {})[path] = get_watch_callback(
+                tasks, stname, box, path, power, source='jmap')
+        elif 'imapstore' in store:
 
             def makecon(con, store=store):
                 if con:
@@ -115,48 +257,235 @@ def start_watching(tasks, syncmap, stores, cpool, period=60):
                         store['host'], store['user'], store['pass'],
                         store['port'], store['ssltype'])
 
-            callback = get_watch_callback(tasks, stname, box, path)
+            callback = get_watch_callback(tasks, stname, box, path, power,
+                                          tiers)
+            callbacks[(stname, box, path)] = callback
             t = Thread(target=watch_errors,
-                       args=(makecon, path, callback, tasks))
+                       args=(makecon, path, callback, tasks, gate,
+                             (stname, box, path), cpool.discard))
             t.daemon = True
             t.start()
+    for stname, paths in jmap_callbacks.items():
+        start_jmap_watching(tasks, stores[stname], paths, stop)
     # run a single thread tracking all maildir changes
-    t = Thread(target=watch_local, args=(tasks, period))
+    t = Thread(target=watch_local, args=(tasks, period, stop, power))
     t.daemon = True
     t.start()
+    return callbacks
+
+
+class SyncTimeout(Exception):
+    pass
+
+
+class SyncCommand:
+    """Sync command with per-channel timeouts and resource limits.
+
+    timeouts is a dict {channel: seconds}, the None key holds the default.
+    rlimits is a dict {'RLIMIT_*': limit} of resource limits applied to the
+    command. If user is given, the command is run as that user. If config
+    is given, it's passed to the command with -c option.
+    """
+
+    # seconds between SIGTERM and SIGKILL
+    grace_period = 10
+
+    def __init__(self, command, timeouts=None, rlimits=None, user=None,
+                 config=None, directional=True):
+        self.command = command
+        self.timeouts = timeouts or {}
+        self.rlimits = rlimits or {}
+        self.user = user
+        self.config = config
+        self.directional = directional
+
+    def for_tenant(self, user, config):
+        return SyncCommand(self.command, self.timeouts, self.rlimits,
+                           user, config, self.directional)
+
+    def get_env(self):
+        return get_user_env(self.user) if self.user else None
+
+    def get_timeout(self, chnames):
+        """Return the largest timeout of chnames or None if none has one."""
+        timeouts = [self.timeouts.get(ch, self.timeouts.get(None))
+                    for ch in chnames]
+        timeouts = [timeout for timeout in timeouts if timeout is not None]
+        if timeouts:
+            return max(timeouts)
+
+    def split_by_timeout(self, mailboxes):
+        """Split {channel: boxes} dict into dicts of channels with the same
+        timeout, so that a channel without timeout isn't killed and a hung
+        channel with timeout doesn't block the others."""
+        parts = OrderedDict()
+        for ch, boxes in mailboxes.items():
+            timeout = self.get_timeout([ch])
+            parts.setdefault(timeout, OrderedDict())[ch] = boxes
+        return list(parts.values())
+
+    def get_popen_args(self):
+        """Return keyword arguments of Popen running the command.
+
+        Everything the child needs is looked up here: after fork in a
+        threaded process the child must not import modules or take locks.
+        """
+        kwargs = dict(env=self.get_env())
+        rlimits = []
+        if self.rlimits:
+            import resource
+            setrlimit = resource.setrlimit
+            rlimits = [(getattr(resource, name), (limit, limit))
+                       for name, limit in self.rlimits.items()]
+        # a new session lets us kill the command with all its children
+        if PY3:
+            kwargs['start_new_session'] = True
+        ids = get_user_ids(self.user) if self.user else None
+        if rlimits or ids or not PY3:
+
+            def preexec():
+                if not PY3:
+                    os.setsid()
+                for which, limits in rlimits:
+                    setrlimit(which, limits)
+                if ids:
+                    demote(ids)
+
+            kwargs['preexec_fn'] = preexec
+        return kwargs
+
+
+def _wait_process(proc, timeout):
+    """Wait for proc for at most timeout seconds and return its exit code
+    or None if it's still running."""
+    deadline = time.time() + timeout
+    while proc.poll() is None and time.time() < deadline:
+        time.sleep(0.1)
+    return proc.returncode
+
+
+def _kill_process_group(proc, grace_period):
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        try:
+            os.killpg(proc.pid, sig)
+        except OSError:
+            break
+        if _wait_process(proc, grace_period) is not None:
+            break
+        logger.warning("sync command didn't terminate in %ds",
+                       grace_period)
+
+
+SYNC_OPTIONS = {'pull': '--pull', 'push': '--push', 'new': '--new'}
 
 
-def run_sync_command(command, mailboxes):
-    """Sync. mailboxes is a dict {channel: [box1, box2, ...]}."""
+def group_sync_pairs(items, syncmap, channels, directional=True):
+    """Group (syncpair, source) items by the sync options they need.
+
+    Return a list of (options, mailboxes) where mailboxes is a dict
+    {channel: [box1, box2, ...]} to sync with options. A mailbox changed on
+    both sides or in different ways is synced with combined options.
+    """
+    needs = OrderedDict()
+    for (st, box, path), source in items:
+        ch = syncmap[(st, box, path)][-1]
+        key = (ch, box if 'patterns' in channels[ch] else None)
+        if directional and source is not None:
+            need = (get_sync_direction(channels[ch], st),
+                    'new' if source == 'idle' else None)
+        else:
+            need = (None, None)
+        needs.setdefault(key, set()).add(need)
+    groups = OrderedDict()
+    for (ch, box), boxneeds in needs.items():
+        directions = set(direction for direction, _ in boxneeds)
+        ops = set(op for _, op in boxneeds)
+        direction = directions.pop() if len(directions) == 1 else None
+        op = ops.pop() if len(ops) == 1 else None
+        options = tuple(SYNC_OPTIONS[o] for o in (direction, op) if o)
+        mailboxes = groups.setdefault(options, OrderedDict())
+        if box is None:
+            mailboxes[ch] = []      # whole channel
+        elif ch not in mailboxes or mailboxes[ch]:
+            mailboxes.setdefault(ch, []).append(box)
+    return list(groups.items())
+
+
+def run_sync_command(command, mailboxes, trace_ids=(), options=()):
+    """Sync. mailboxes is a dict {channel: [box1, box2, ...]}.
+    command is a SyncCommand, options are passed to it before channels."""
+    import subprocess
     args = [ch + (':' + ','.join(boxes) if boxes else '')
             for ch, boxes in mailboxes.items()]
-    if ' ' in command:
+    timeout = command.get_timeout(mailboxes)
+    args = list(options) + args
+    if command.config:
+        args = ['-c', command.config] + args
+    if ' ' in command.command:
         shell = True
-        command = ' '.join([command] + ["'%s'" % arg for arg in args])
+        cmd = ' '.join([command.command] + ["'%s'" % arg for arg in args])
     else:
         shell = False
-        command = [command] + args
-    logger.info(command if shell else ' '.join(command))
-    subprocess.check_call(command, shell=shell)
+        cmd = [command.command] + args
+    logger.info(cmd if shell else ' '.join(cmd))
+    tracing.record_all(trace_ids, 'sync_start')
+    proc = subprocess.Popen(cmd, shell=shell, **command.get_popen_args())
+    try:
+        if timeout is None:
+            returncode = proc.wait()
+        else:
+            returncode = _wait_process(proc, timeout)
+    except BaseException:
+        _kill_process_group(proc, command.grace_period)
+        raise
+    if returncode is None:
+        logger.error("sync command timed out after %ds", timeout)
+        _kill_process_group(proc, command.grace_period)
+        tracing.record_all(trace_ids, 'sync_end', returncode=None)
+        raise SyncTimeout("sync command timed out after %ds" % timeout)
+    tracing.record_all(trace_ids, 'sync_end', returncode=returncode)
+    if returncode:
+        raise subprocess.CalledProcessError(returncode, cmd)
     logger.debug("command completed")
 
 
-def task_loop(tasks, syncmap, channels, stores, command):
+def list_maildirs(syncmap, stores):
+    """Return {path to cur directory: set of message files} of maildirs."""
     dircache = {}
+    for stname, box, path in syncmap:
+        if 'maildirstore' in stores[stname]:
+            cur = os.path.join(path, 'cur')
+            dircache[cur] = set(os.listdir(cur))
+    return dircache
+
+
+def task_loop(tasks, syncmap, channels, stores, command, report=None,
+              journal=None, power=None):
+    dircache = list_maildirs(syncmap, stores)
+    # syncs waiting for the next low-power window
+    deferred = []
     while True:
 
+        timeout = 1e9
+        if deferred:
+            timeout = max(0, power.next_window() - time.time())
         try:
             # do not block to make keyboard interrupts work instantly
-            task = tasks.get(True, 1e9)
+            task = tasks.get(True, timeout)
         except queue.Empty:
+            for task in merge_sync_tasks(deferred):
+                tasks.put_nowait(task)
+            deferred = []
             continue
 
         if isinstance(task, ErrorTask):
             logger.error(task.exc, exc_info=task.exc_info)
+            if report:
+                report('error', str(task.exc))
             raise SystemExit(1)
         elif isinstance(task, LocalMailTask):
             logger.debug("check maildir changes")
-            pairs = []
+            pairs, cids = [], []
             for stname, box, path in syncmap:
                 store = stores[stname]
                 if 'maildirstore' in store:
@@ -164,38 +493,289 @@ def task_loop(tasks, syncmap, channels, stores, command):
                     dirset = set(os.listdir(cur))
                     if dircache.get(cur) != dirset:
                         logger.info("%s updated", path)
-                        pairs.append(syncmap[(stname, box, path)][:-1])
+                        pairs.append((stname, box, path))
+                        cid = tracing.new_id()
+                        tracing.record(cid, 'event', source='scan',
+                                       store=stname, mailbox=box)
+                        cids.append(cid)
                     dircache[cur] = dirset
             if pairs:
-                tasks.put_nowait(SyncTask(pairs))
+                tracing.record_all(cids, 'enqueue')
+                tasks.put_nowait(SyncTask(pairs, cids, 'local'))
             logger.debug("check completed")
         elif isinstance(task, SyncTask):
+            if power and power.should_defer(task):
+                logger.debug("sync deferred to the next window")
+                deferred.append(task)
+                tasks.task_done()
+                continue
+            if deferred and not task.merged:
+                # run deferred syncs together with this one
+                for task in merge_sync_tasks(deferred + [task]):
+                    tasks.put_nowait(task)
+                deferred = []
+                tasks.task_done()
+                continue
+            tracing.record_all(task.trace_ids, 'dequeue')
+            if power:
+                power.wakeup('sync')
             # sync
-            mailboxes = defaultdict(list)
-            for st, box, path in task.syncpairs:
-                ch = syncmap[(st, box, path)][-1]
-                if 'patterns' in channels[ch]:
-                    mailboxes[ch].append(box)
-                else:
-                    mailboxes[ch] = []
-            run_sync_command(command, mailboxes)
-
-            # update parts of dircache
-            for st, box, path in task.syncpairs:
-                st2, bx2, pt2, _ = syncmap[(st, box, path)]
-                store = stores[st2]
-                if 'maildirstore' in store:
-                    cur = os.path.join(pt2, 'cur')
-                    dircache[cur] = set(os.listdir(cur))
+            groups = group_sync_pairs(
+                [(pair, task.source) for pair in task.syncpairs],
+                syncmap, channels, command.directional)
+            task.attempts += 1
+            try:
+                for options, mailboxes in groups:
+                    for part in command.split_by_timeout(mailboxes):
+                        run_sync_command(command, part, task.trace_ids,
+                                         options)
+            except SyncTimeout:
+                chnames = ' '.join(sorted(set(
+                    ch for _, mailboxes in groups for ch in mailboxes)))
+                if task.attempts < task.max_attempts:
+                    logger.info("sync of %s is queued again", chnames)
+                    tasks.put_nowait(task)
+                    tasks.task_done()
+                    continue
+                logger.error("giving up sync of %s after %d attempts",
+                             chnames, task.attempts)
+            else:
+                if report:
+                    report('synced', len(task.syncpairs))
+
+                # update parts of dircache
+                for pair in task.syncpairs:
+                    for st, box, path in (pair, syncmap[pair][:-1]):
+                        if 'maildirstore' in stores[st]:
+                            cur = os.path.join(path, 'cur')
+                            dircache[cur] = set(os.listdir(cur))
+            if journal:
+                journal.done(task.journal_pairs)
         else:
             raise TypeError('task must be instance of some derivative of Task')
         tasks.task_done()
 
 
-def make_sync_all_task(syncmap, stores):
+def make_sync_all_task(syncmap, stores, exclude=()):
+    """Return SyncTask fully syncing all mailboxes of syncmap but those
+    of which one side is in exclude."""
     # prefer imap stores over maildirs, so the sync will be update dircache
     return SyncTask(list(set([p1 if 'imapstore' in stores[p1[0]] else p2[:-1]
-                              for p1, p2 in syncmap.items()])))
+                              for p1, p2 in syncmap.items()
+                              if p1 not in exclude and
+                              p2[:-1] not in exclude])))
+
+
+def get_network_change_handler(tasks, syncmap, stores, cpool):
+
+    def handler(reason):
+        logger.info("network changed (%s), reconnecting", reason)
+        cpool.interrupt_all()
+        tasks.put_nowait(make_sync_all_task(syncmap, stores))
+
+    return handler
+
+
+def get_power_manager(policy, gate, tasks, syncmap, stores, stop):
+    """Return PowerManager blocking IDLE of IMAP mailboxes without
+    priority and syncing them at the start of every window instead."""
+    priority = get_priority_pairs(syncmap, policy.priority)
+    keys = [pair for pair in syncmap
+            if 'imapstore' in stores[pair[0]] and pair not in priority]
+
+    def on_window():
+        if keys:
+            tasks.put_nowait(SyncTask(keys, source='idle', window=True))
+
+    def on_change(low):
+        # catch up with mail which arrived while IDLE was blocked
+        if not low:
+            on_window()
+
+    return PowerManager(policy, gate, keys, priority, on_window, on_change,
+                        stop)
+
+
+def replay_journal(tasks, journal, syncmap):
+    """Queue syncs left pending by the previous run and return their pairs.
+    They are synced fully, since the full sync at startup would sync them
+    again otherwise."""
+    pairs = []
+    for pair, _ in journal.outstanding():
+        if pair in syncmap:
+            pairs.append(pair)
+        else:
+            journal.done([pair])
+    if pairs:
+        logger.info("replaying %d pending syncs", len(pairs))
+        tasks.put_nowait(SyncTask(pairs))
+    return set(pairs)
+
+
+def get_catch_up(tasks):
+    """Return function queuing syncs of mailboxes given by keys which were
+    not watched for a while."""
+
+    def catch_up(keys):
+        tasks.put_nowait(SyncTask(keys, source='idle'))
+
+    return catch_up
+
+
+def get_mailbox_tiers(policy, gate, syncmap, stores, namespace=None):
+    """Return MailboxTiers of the mailboxes watched with IDLE."""
+    keys = [pair for pair in syncmap if 'imapstore' in stores[pair[0]] and
+            'jmapurl' not in stores[pair[0]]]
+    path = os.path.join(get_cache_dir(), 'tiers-%s.json' % namespace
+                        if namespace else 'tiers.json')
+    return MailboxTiers(policy, keys, gate, path)
+
+
+def watch_channels(channels, command, verbose=False, report=None,
+                   namespace=None, netmon=True, journal=None, power=None,
+                   tiering=None):
+    """Watch channels and sync them with SyncCommand command until an error
+    occurs. namespace separates connections and caches of different users
+    watched by the same process. If netmon is true, all connections are
+    reestablished on network changes. If journal path is given, queued syncs
+    are saved there and after restart they are synced first, before all
+    other mailboxes catch up. power is a PowerPolicy enabling low-power
+    mode. tiering is a TierPolicy moving rarely changing mailboxes from IDLE
+    to polling."""
+    from .imapidle import ConnectionPool
+    from .netmon import ConnectivityMonitor
+    stores = dict(iterate_stores(channels))
+    logger.debug("stores: %s", stores)
+
+    cache = MailboxCache(namespace and os.path.join(
+        get_cache_dir(), 'mailboxes-%s.json' % namespace))
+    cpool = ConnectionPool(debug=verbose, namespace=namespace)
+    gate = WatchGate()
+    stop = Event()
+    if journal:
+        journal = SyncJournal(journal)
+    try:
+        populate_stores_w_mailboxes(stores, cpool, cache, user=command.user,
+                                    channels=channels)
+        syncmap = get_syncmap(channels)
+        logger.debug("syncmap: %s", syncmap)
+
+        tasks = JournaledQueue(journal) if journal else queue.Queue()
+
+        manager = None
+        if power:
+            manager = get_power_manager(power, gate, tasks, syncmap, stores,
+                                        stop)
+            manager.check()
+            manager.start()
+        tiers = None
+        if tiering:
+            tiers = get_mailbox_tiers(tiering, gate, syncmap, stores,
+                                      namespace)
+            # don't connect mailboxes which were already cold
+            tiers.update()
+            tiers.report()
+        callbacks = start_watching(tasks, syncmap, stores, cpool, stop=stop,
+                                   gate=gate, power=manager, tiers=tiers)
+        if tiers:
+            poller = ColdPoller(tiers, stores, cpool, callbacks, stop,
+                                manager, get_catch_up(tasks))
+            # before the full sync, which syncs changes made until then
+            poller.prime()
+            poller.start()
+        cpool.start_maintenance(stop)
+        if netmon:
+            handler = get_network_change_handler(tasks, syncmap, stores,
+                                                 cpool)
+            ConnectivityMonitor(handler, stop=stop, power=manager).start()
+
+        synced = ()
+        if journal and journal.existed:
+            synced = replay_journal(tasks, journal, syncmap)
+        # catch up with changes made while not watching
+        syncall = make_sync_all_task(syncmap, stores, synced)
+        if syncall.syncpairs:
+            tasks.put_nowait(syncall)
+
+        task_loop(tasks, syncmap, channels, stores, command, report, journal,
+                  manager)
+    finally:
+        stop.set()
+        cpool.close_all()
+        if journal:
+            journal.close()
+
+
+def list_mailboxes(channels, refresh=False, verbose=False):
+    """Print mailboxes of the channels using cached mailbox lists unless
+    refresh is requested."""
+    from .imapidle import ConnectionPool
+    stores = dict(iterate_stores(channels))
+    cpool = ConnectionPool(debug=verbose)
+    try:
+        populate_stores_w_mailboxes(stores, cpool, MailboxCache(), refresh,
+                                    channels=channels)
+    finally:
+        cpool.close_all()
+    syncmap = get_syncmap(channels)
+    for chname, box in iterate_channel_boxes(channels, syncmap):
+        print(chname if box is None else '%s:%s' % (chname, box))
+
+
+def run_worker(wid, channels, status, command, verbose, trace=None,
+               profile_dir=None, netmon=True, journal=None, power=None,
+               tiering=None):
+    """Entry point of a supervised worker process."""
+    signal.signal(signal.SIGTERM, terminate_once_handler)
+    if profile_dir:
+        SignalProfiler(profile_dir).install()
+    if trace:
+        tracing.setup_tracing('%s.%d' % (trace, wid))
+
+    def report(event, value):
+        status.put((wid, event, value))
+
+    report('running', os.getpid())
+    try:
+        watch_channels(channels, command, verbose, report, netmon=netmon,
+                       journal=journal and '%s.%d' % (journal, wid),
+                       power=power, tiering=tiering)
+    except get_fatal_errors() + (Terminate,) as e:
+        logger.error("worker %d: %s", wid, e)
+        report('error', str(e))
+        raise SystemExit(1)
+    except KeyboardInterrupt:
+        raise SystemExit(1)
+
+
+def get_temp_dir():
+    import tempfile
+    return tempfile.gettempdir()
+
+
+def get_tier_policy(args):
+    if args.cold_after or args.max_idle:
+        return TierPolicy(args.cold_after or TierPolicy().cold_after,
+                          args.max_idle)
+
+
+def watch_tenants(args):
+    """Serve configs of several users from a single process."""
+    signal.signal(signal.SIGTERM, terminate_handler)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    SignalProfiler(args.profile_dir or get_temp_dir()).install()
+    if args.trace:
+        tracing.setup_tracing(args.trace)
+    tenants = [Tenant.from_spec(spec) for spec in args.tenants]
+    command = SyncCommand(args.command, args.timeouts, args.rlimits,
+                          directional=not args.full)
+    power = PowerPolicy(args.low_power or 'off', args.priority)
+    try:
+        TenantRunner(watch_channels, tenants, command, args.verbose,
+                     args.netmon, args.journal, power,
+                     get_tier_policy(args)).run()
+    except (KeyboardInterrupt, Terminate) as e:
+        logger.error(e)
 
 
 def main():
@@ -220,7 +800,21 @@ def main():
         logger.error(args.error)
         raise SystemExit(2)
 
-    if not args.pos_args:
+    if args.tenants:
+        if args.pos_args or args.all_ or args.list_ or args.jobs > 1 or \
+                args.subscribed or args.jmap:
+            logger.error("--tenant can't be combined with channels, "
+                         "--all, --list, --jobs, --subscribed or --jmap")
+            raise SystemExit(2)
+        watch_tenants(args)
+        raise SystemExit(1)
+
+    if args.low_power and not args.pos_args and not args.all_:
+        # switch running instances
+        write_control(args.low_power)
+        raise SystemExit(0)
+
+    if not args.pos_args and not args.all_:
         logger.error("No channel specified. Try 'mbwatch -h'")
         raise SystemExit(1)
 
@@ -228,44 +822,60 @@ def main():
         config = read_config(args.mbsyncrc)
         channels = get_channels(args, config)
         logger.debug("channels: %s", channels)
+        if args.subscribed:
+            for _, store in iterate_stores(channels):
+                store['subscribedonly'] = True
+        imapstores = config.get('imapstore', {})
+        for stname, url in args.jmap.items():
+            if stname not in imapstores:
+                raise ChannelError("--jmap: no IMAP store '%s'" % stname)
+            imapstores[stname]['jmapurl'] = url
     except (ConfigError, ChannelError) as e:
         logger.error(e)
         raise SystemExit(1)
 
-    stores = dict(iterate_stores(channels))
-    logger.debug("stores: %s", stores)
-
-    # handle signals
-    class Terminate(Exception):
-        pass
+    if args.list_:
+        import socket
+        try:
+            list_mailboxes(channels, args.refresh, args.verbose)
+        except get_fatal_errors() + (socket.error,) as e:
+            logger.error(e)
+            raise SystemExit(1)
+        raise SystemExit(0)
 
-    def signal_handler(signum, frame):
-        raise Terminate("signal %s" % signum)
+    if args.trace and args.jobs == 1:
+        tracing.setup_tracing(args.trace)
 
-    signal.signal(signal.SIGTERM, signal_handler)
+    # handle signals
+    signal.signal(signal.SIGTERM, terminate_handler)
     signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    profile_dir = args.profile_dir or get_temp_dir()
+    command = SyncCommand(args.command, args.timeouts, args.rlimits,
+                          directional=not args.full)
+    power = PowerPolicy(args.low_power or 'off', args.priority)
+    tiering = get_tier_policy(args)
 
-    cpool = ConnectionPool(debug=args.verbose)
     try:
-        populate_stores_w_mailboxes(stores, cpool)
-        syncmap = get_syncmap(channels)
-        logger.debug("syncmap: %s", syncmap)
-
-        tasks = queue.Queue()
-
-        start_watching(tasks, syncmap, stores, cpool)
-
-        syncall = make_sync_all_task(syncmap, stores)
-        tasks.put_nowait(syncall)
-
-        task_loop(tasks, syncmap, channels, stores, args.command)
+        if args.jobs > 1:
+            from .supervisor import Supervisor, partition_channels
+            parts = partition_channels(channels, args.jobs)
+            supervisor = Supervisor(run_worker, parts,
+                                    (command, args.verbose, args.trace,
+                                     profile_dir, args.netmon,
+                                     args.journal, power, tiering))
+            # profile workers, not the supervisor
+            for signum in (signal.SIGUSR1, signal.SIGUSR2):
+                signal.signal(signum, supervisor.forward_signal)
+            supervisor.run()
+        else:
+            SignalProfiler(profile_dir).install()
+            watch_channels(channels, command, args.verbose,
+                           netmon=args.netmon, journal=args.journal,
+                           power=power, tiering=tiering)
 
-    except (IMAP4.error, PasswordError, MailboxError,
-            subprocess.CalledProcessError, KeyboardInterrupt, Terminate) as e:
+    except get_fatal_errors() + (KeyboardInterrupt, Terminate) as e:
         logger.error(e)
         raise SystemExit(1)
-    finally:
-        cpool.close_all()
 
 
 if __name__ == '__main__':
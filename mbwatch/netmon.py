@@ -0,0 +1,158 @@
+"""Detection of suspend/resume and network configuration changes."""
+
+import logging
+import select
+import socket
+import struct
+from threading import Event, Thread
+import time
+
+
+logger = logging.getLogger(__name__)
+
+NETLINK_ROUTE = 0
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+RTMGRP_IPV4_ROUTE = 0x40
+RTMGRP_IPV6_IFADDR = 0x100
+RTMGRP_IPV6_ROUTE = 0x400
+# RTM_NEWLINK, RTM_DELLINK, RTM_NEWADDR, RTM_DELADDR, RTM_NEWROUTE,
+# RTM_DELROUTE
+RTM_TYPES = {16: 'link', 17: 'link', 20: 'address', 21: 'address',
+             24: 'route', 25: 'route'}
+NLMSGHDR = struct.Struct('=IHHII')
+# documentation addresses (RFC 5737, RFC 3849) reached over default routes
+PROBE_ADDRESSES = ((socket.AF_INET, '192.0.2.1'),
+                   (getattr(socket, 'AF_INET6', None), '2001:db8::1'))
+
+monotonic = getattr(time, 'monotonic', None)
+
+
+def open_netlink():
+    """Return a socket receiving link, address and route changes or None
+    if netlink is not available."""
+    try:
+        sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW,
+                             NETLINK_ROUTE)
+        sock.bind((0, RTMGRP_LINK | RTMGRP_IPV4_IFADDR | RTMGRP_IPV4_ROUTE |
+                   RTMGRP_IPV6_IFADDR | RTMGRP_IPV6_ROUTE))
+        return sock
+    except (AttributeError, socket.error) as e:
+        logger.debug("netlink is not available: %s", e)
+
+
+def parse_netlink(data):
+    """Return kinds of changes contained in netlink messages."""
+    kinds = set()
+    offset = 0
+    while offset + NLMSGHDR.size <= len(data):
+        length, typ, _, _, _ = NLMSGHDR.unpack_from(data, offset)
+        if typ in RTM_TYPES:
+            kinds.add(RTM_TYPES[typ])
+        if length < NLMSGHDR.size:
+            break
+        offset += (length + 3) & ~3
+    return kinds
+
+
+def get_route_state():
+    """Return source addresses of IPv4 and IPv6 default routes, None for
+    a family without route. Connecting a UDP socket only looks up the
+    route, nothing is sent."""
+    state = []
+    for family, address in PROBE_ADDRESSES:
+        source = None
+        if family is not None:
+            sock = None
+            try:
+                sock = socket.socket(family, socket.SOCK_DGRAM)
+                sock.connect((address, 9))
+                source = sock.getsockname()[0]
+            except (socket.error, OSError):
+                pass
+            finally:
+                if sock is not None:
+                    sock.close()
+        state.append(source)
+    return tuple(state)
+
+
+class ConnectivityMonitor:
+    """Call callback(reason) when the host resumed from suspend or its
+    network configuration changed.
+
+    Wall clock running ahead of the monotonic clock (which doesn't advance
+    while the host sleeps) by more than jump seconds means a resume. Bursts
+    of changes are coalesced: callback is called once, settle seconds after
+    the last change. Netlink changes count only if they changed the source
+    address of a default route, so address lifetime refreshes and links of
+    containers don't cause reconnects; losing the route isn't reported
+    either, getting it back is. If power manager is given, wakeups are
+    counted in it and the clock is checked less often in low-power mode.
+    """
+
+    def __init__(self, callback, interval=10, jump=30, settle=5, stop=None,
+                 power=None):
+        self.callback = callback
+        self.power = power
+        self.interval = interval
+        self.jump = jump
+        self.settle = settle
+        self.stop = stop or Event()
+
+    def start(self):
+        t = Thread(target=self.run, name='netmon')
+        t.daemon = True
+        t.start()
+
+    def run(self):
+        sock = open_netlink()
+        if sock is None and monotonic is None:
+            logger.debug("connectivity monitor is not supported")
+            return
+        now = time.time
+        mono = monotonic or now
+        last_wall, last_mono = now(), mono()
+        routes = get_route_state()
+        reasons, changed = set(), None
+        try:
+            while not self.stop.is_set():
+                timeout = self.interval
+                if self.power:
+                    timeout = self.power.poll_delay(timeout)
+                if changed is not None:
+                    timeout = max(0, changed + self.settle - mono())
+                if sock is not None:
+                    ready = select.select([sock], [], [], timeout)[0]
+                    if ready:
+                        kinds = parse_netlink(sock.recv(65536))
+                        if kinds:
+                            reasons.update(kinds)
+                            changed = mono()
+                else:
+                    time.sleep(timeout)
+                if self.power:
+                    self.power.wakeup('netmon')
+                wall, mon = now(), mono()
+                if monotonic and (wall - last_wall) - (mon - last_mono) > \
+                        self.jump:
+                    reasons.add('resume')
+                    changed = mon
+                last_wall, last_mono = wall, mon
+                if changed is not None and mon - changed >= self.settle:
+                    reason = ', '.join(sorted(reasons))
+                    old, routes = routes, get_route_state()
+                    resumed = 'resume' in reasons
+                    reasons, changed = set(), None
+                    if not resumed and (routes == old or not any(routes)):
+                        logger.debug("ignoring network change (%s), routes "
+                                     "%s -> %s", reason, old, routes)
+                        continue
+                    try:
+                        self.callback(reason)
+                    except Exception as e:
+                        logger.error("network change handler failed: %s", e,
+                                     exc_info=True)
+        finally:
+            if sock is not None:
+                sock.close()
@@ -0,0 +1,214 @@
+"""Low-power mode for battery-powered hosts."""
+
+from collections import defaultdict
+import logging
+import os
+from threading import Event, RLock, Thread
+import time
+
+from .cache import get_cache_dir, write_atomic
+
+
+logger = logging.getLogger(__name__)
+
+POWER_SUPPLY_DIR = '/sys/class/power_supply'
+MODES = ('on', 'off', 'auto')
+
+
+def _read(path):
+    try:
+        with open(path) as file:
+            return file.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+def on_battery(root=POWER_SUPPLY_DIR):
+    """Return True if the host runs on battery, False if it's on external
+    power or None if it can't be told."""
+    try:
+        names = os.listdir(root)
+    except OSError:
+        return None
+    battery = None
+    for name in names:
+        path = os.path.join(root, name)
+        typ = _read(os.path.join(path, 'type'))
+        if typ == 'Battery':
+            status = _read(os.path.join(path, 'status'))
+            if status == 'Discharging':
+                battery = True
+            elif status and battery is None:
+                battery = False
+        elif _read(os.path.join(path, 'online')) == '1':
+            return False        # mains, USB or other external supply
+    return battery
+
+
+def get_control_path():
+    return os.path.join(get_cache_dir(), 'low-power')
+
+
+def write_control(mode, path=None):
+    """Switch low-power mode of running mbwatch processes."""
+    write_atomic(path or get_control_path(), mode + '\n')
+
+
+def get_priority_pairs(syncmap, specs):
+    """Return syncmap keys of the mailboxes given by CHANNEL[:BOX,...]
+    specs."""
+    boxes = {}
+    for spec in specs:
+        channel, _, names = spec.partition(':')
+        boxes[channel] = set(names.split(',')) if names else None
+    pairs = set()
+    for pair, other in syncmap.items():
+        chname = other[3]
+        if chname in boxes and (boxes[chname] is None or
+                                pair[1] in boxes[chname]):
+            pairs.add(pair)
+    return pairs
+
+
+class PowerPolicy:
+    """Low-power settings.
+
+    mode is 'on', 'off' or 'auto' (low power while the host runs on
+    battery). priority is a list of CHANNEL[:BOX,...] specs of mailboxes
+    which keep IDLE and are synced immediately in low-power mode. Running
+    processes switch mode when the control file is written after they
+    started.
+    """
+
+    # seconds between shared wakeups in low-power mode
+    window = 300
+
+    def __init__(self, mode='off', priority=(), control=None):
+        self.mode = mode
+        self.priority = list(priority)
+        self.control = control or get_control_path()
+
+
+class PowerManager:
+    """Switch watching into low-power mode and back.
+
+    In low-power mode watchers of keys, the IMAP mailboxes without
+    priority, are blocked in gate and on_window is called at the start of
+    every window to have them checked instead. Syncs which are not of
+    priority mailboxes are deferred to the next window. Windows are aligned
+    to the wall clock, so that all processes on the host wake up together.
+    on_change(low) is called when the mode changes. Wakeups are counted in
+    every mode and reported hourly.
+    """
+
+    # seconds between power state checks outside of low-power mode
+    interval = 60
+    # seconds after the start of a window in which tasks are not deferred
+    slack = 30
+    report_interval = 3600
+
+    def __init__(self, policy, gate, keys, priority=(), on_window=None,
+                 on_change=None, stop=None):
+        self.policy = policy
+        self.gate = gate
+        self.keys = list(keys)
+        self.priority = set(priority)
+        self.on_window = on_window
+        self.on_change = on_change
+        self.stop = stop or Event()
+        self.low = False
+        self.started = time.time()
+        self.lock = RLock()
+        self.wakeups = defaultdict(int)
+        self.since = self.started
+
+    def get_mode(self):
+        """Return mode requested by the control file or the policy."""
+        try:
+            if os.path.getmtime(self.policy.control) >= self.started:
+                mode = _read(self.policy.control)
+                if mode in MODES:
+                    return mode
+                logger.warning("bad low-power mode in %s: %r",
+                               self.policy.control, mode)
+        except OSError:
+            pass
+        return self.policy.mode
+
+    def check(self):
+        mode = self.get_mode()
+        low = mode == 'on' or (mode == 'auto' and bool(on_battery()))
+        if low == self.low:
+            return
+        self.report()
+        self.low = low
+        logger.info("low-power mode %s", 'on' if low else 'off')
+        if low:
+            self.gate.block(self.keys, 'power')
+        else:
+            self.gate.unblock(self.keys, 'power')
+        if self.on_change:
+            self.on_change(low)
+
+    def next_window(self, now=None):
+        """Return time when deferred syncs are due."""
+        now = time.time() if now is None else now
+        if not self.low:
+            return now
+        window = self.policy.window
+        return (now // window + 1) * window
+
+    def in_window(self, now=None):
+        now = time.time() if now is None else now
+        return not self.low or now % self.policy.window < self.slack
+
+    def poll_delay(self, period):
+        """Return seconds to wait before the next periodic check."""
+        if not self.low:
+            return period
+        return self.next_window() - time.time()
+
+    def should_defer(self, task):
+        """Tell whether SyncTask task should wait for the next window.
+        Tasks created at the start of a window have window set."""
+        return (self.low and task.source is not None and
+                not task.window and
+                not self.in_window() and
+                not all(pair in self.priority for pair in task.syncpairs))
+
+    def wakeup(self, kind):
+        with self.lock:
+            self.wakeups[kind] += 1
+
+    def report(self):
+        """Log wakeups per hour since the last report and reset them."""
+        now = time.time()
+        with self.lock:
+            wakeups, self.wakeups = self.wakeups, defaultdict(int)
+            elapsed, self.since = now - self.since, now
+        if elapsed < 1:
+            return
+        total = sum(wakeups.values())
+        logger.info("%.1f wakeups/hour in %s mode over %dm (%s)",
+                    total * 3600.0 / elapsed,
+                    'low-power' if self.low else 'normal', elapsed // 60,
+                    ', '.join('%s %d' % item
+                              for item in sorted(wakeups.items())) or 'none')
+
+    def start(self):
+        t = Thread(target=self.run, name='power')
+        t.daemon = True
+        t.start()
+
+    def run(self):
+        while not self.stop.wait(self.poll_delay(self.interval)):
+            self.wakeup('power')
+            try:
+                low = self.low
+                self.check()
+                if low and self.low and self.on_window:
+                    self.on_window()
+            except Exception as e:
+                logger.error("low-power check failed: %s", e, exc_info=True)
+            if time.time() - self.since >= self.report_interval:
+                self.report()
@@ -0,0 +1,172 @@
+"""On-demand profiling of a running daemon.
+
+SIGUSR1 starts a sampling profiler over all threads and, when received
+again, stops it and writes a report. SIGUSR2 starts tracemalloc and, on
+subsequent signals, writes the top allocations and the growth since the
+previous snapshot. Reports are written to the profile directory.
+"""
+
+from collections import defaultdict
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class SamplingProfiler:
+    """Periodically sample stacks of all threads of the process."""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = 0
+        self.own = defaultdict(int)
+        self.cumulative = defaultdict(int)
+        self.threads = defaultdict(int)
+        self.started = None
+        self.stopped = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self.started = time.time()
+        self._thread = threading.Thread(target=self._run,
+                                        name='sampling-profiler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.stopped = time.time()
+
+    def _run(self):
+        me = threading.current_thread().ident
+        while not self._stop.wait(self.interval):
+            names = dict((t.ident, t.name) for t in threading.enumerate())
+            for tid, frame in sys._current_frames().items():
+                if tid == me:
+                    continue
+                self.samples += 1
+                self.threads[names.get(tid, tid)] += 1
+                self.own[self._location(frame)] += 1
+                seen = set()
+                while frame is not None:
+                    loc = self._location(frame)
+                    if loc not in seen:
+                        seen.add(loc)
+                        self.cumulative[loc] += 1
+                    frame = frame.f_back
+
+    @staticmethod
+    def _location(frame):
+        code = frame.f_code
+        return code.co_filename, code.co_firstlineno, code.co_name
+
+    def write_report(self, file, limit=40):
+        file.write("%d samples in %.1fs\n\n" %
+                   (self.samples, self.stopped - self.started))
+        file.write("samples per thread:\n")
+        for name, count in sorted(self.threads.items(),
+                                  key=lambda i: -i[1]):
+            file.write("%8d  %s\n" % (count, name))
+        for title, counts in (('own', self.own),
+                              ('cumulative', self.cumulative)):
+            file.write("\ntop functions by %s samples:\n" % title)
+            top = sorted(counts.items(), key=lambda i: -i[1])[:limit]
+            for (filename, lineno, name), count in top:
+                file.write("%8d %5.1f%%  %s (%s:%d)\n" % (
+                    count, 100.0 * count / max(self.samples, 1),
+                    name, filename, lineno))
+
+
+class SignalProfiler:
+    """Handle SIGUSR1 and SIGUSR2 as described in the module docstring."""
+
+    def __init__(self, directory):
+        self.directory = os.path.expanduser(directory)
+        self.profiler = None
+        self.snapshot = None
+        self.lock = threading.Lock()
+
+    def install(self):
+        signal.signal(signal.SIGUSR1, self.toggle_profiler)
+        signal.signal(signal.SIGUSR2, self.dump_memory)
+
+    def toggle_profiler(self, signum=None, frame=None):
+        # do the work outside of the signal handler to not delay watching
+        self._spawn(self._toggle_profiler)
+
+    def dump_memory(self, signum=None, frame=None):
+        self._spawn(self._dump_memory)
+
+    def _spawn(self, target):
+        t = threading.Thread(target=target)
+        t.daemon = True
+        t.start()
+
+    def _path(self, kind):
+        now = time.time()
+        return os.path.join(self.directory, 'mbwatch-%d-%s-%s.%03d.txt' % (
+            os.getpid(), kind, time.strftime('%Y%m%d-%H%M%S',
+                                             time.localtime(now)),
+            now * 1000 % 1000))
+
+    def _toggle_profiler(self):
+        with self.lock:
+            if self.profiler is None:
+                self.profiler = SamplingProfiler()
+                self.profiler.start()
+                logger.info("profiling started")
+                return
+            profiler, self.profiler = self.profiler, None
+        profiler.stop()
+        path = self._path('profile')
+        try:
+            with open(path, 'w') as file:
+                profiler.write_report(file)
+            logger.info("profile written to %s", path)
+        except (IOError, OSError) as e:
+            logger.error("can't write profile: %s", e)
+
+    def _dump_memory(self):
+        try:
+            import tracemalloc
+        except ImportError:
+            logger.error("tracemalloc is not available")
+            return
+        with self.lock:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(10)
+                logger.info("memory tracing started")
+                return
+            snapshot = tracemalloc.take_snapshot().filter_traces((
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            ))
+            previous, self.snapshot = self.snapshot, snapshot
+        path = self._path('memory')
+        try:
+            with open(path, 'w') as file:
+                current, peak = tracemalloc.get_traced_memory()
+                file.write("traced memory: %d bytes, peak %d bytes\n" %
+                           (current, peak))
+                file.write("\ntop allocations:\n")
+                for stat in snapshot.statistics('lineno')[:40]:
+                    file.write("%s\n" % stat)
+                if previous is not None:
+                    file.write("\ngrowth since previous snapshot:\n")
+                    for stat in snapshot.compare_to(previous, 'lineno')[:40]:
+                        file.write("%s\n" % stat)
+                file.write("\ntop allocation tracebacks:\n")
+                for stat in snapshot.statistics('traceback')[:10]:
+                    file.write("\n%s\n" % stat)
+                    for line in stat.traceback.format():
+                        file.write("%s\n" % line)
+            logger.info("memory snapshot written to %s", path)
+        except (IOError, OSError) as e:
+            logger.error("can't write memory snapshot: %s", e)
@@ -0,0 +1,183 @@
+from collections import OrderedDict
+import logging
+import multiprocessing
+import os
+import signal
+import time
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from .util import Backoff
+
+
+logger = logging.getLogger(__name__)
+
+
+def _imap_stores(channel):
+    for stype in ('master', 'slave'):
+        if 'imapstore' in channel[stype]:
+            yield channel[stype]['imapstore']
+
+
+def partition_channels(channels, nparts):
+    """Split channels into at most nparts OrderedDicts.
+
+    Channels sharing an IMAP store are kept in the same part, so every
+    account is logged in from a single process only. Maildir stores are
+    local and may be shared between parts.
+    """
+    # union-find over channel names linked by common imap stores
+    parent = dict((chname, chname) for chname in channels)
+
+    def find(chname):
+        while parent[chname] != chname:
+            parent[chname] = parent[parent[chname]]
+            chname = parent[chname]
+        return chname
+
+    owners = {}
+    for chname, channel in channels.items():
+        for stname in _imap_stores(channel):
+            if stname in owners:
+                parent[find(chname)] = find(owners[stname])
+            else:
+                owners[stname] = chname
+    groups = OrderedDict()
+    for chname in channels:
+        groups.setdefault(find(chname), []).append(chname)
+    # greedy bin packing, largest groups first
+    parts = [OrderedDict() for _ in range(min(nparts, len(groups)))]
+    for group in sorted(groups.values(), key=len, reverse=True):
+        part = min(parts, key=len)
+        for chname in group:
+            part[chname] = channels[chname]
+    return parts
+
+
+class Worker:
+    """State of a single worker process as seen by the supervisor."""
+
+    def __init__(self, wid, channels):
+        self.wid = wid
+        self.channels = channels
+        self.process = None
+        self.state = 'stopped'
+        self.pid = None
+        self.started = None
+        self.restarts = 0
+        self.syncs = 0
+        self.last_sync = None
+        self.last_error = None
+        self.backoff = Backoff()
+        self.restart_at = None
+
+
+class Supervisor:
+    """Run target(wid, channels, status, *args) in a process per channel part
+    and restart crashed processes with exponential backoff.
+
+    Workers report their state by putting (wid, event, value) tuples to the
+    status queue: ('running', pid), ('synced', count) or ('error', message).
+    """
+
+    def __init__(self, target, parts, args=()):
+        self.target = target
+        self.args = args
+        self.status_queue = multiprocessing.Queue()
+        self.workers = [Worker(wid, channels)
+                        for wid, channels in enumerate(parts)]
+
+    def run(self):
+        for worker in self.workers:
+            self._start(worker)
+        try:
+            while True:
+                self._drain_status(timeout=1)
+                self._check_workers()
+        finally:
+            self.stop()
+
+    # seconds to wait for workers to exit before killing them
+    stop_timeout = 5
+
+    def stop(self):
+        for worker in self.workers:
+            if worker.process and worker.process.is_alive():
+                worker.process.terminate()
+        deadline = time.time() + self.stop_timeout
+        for worker in self.workers:
+            if worker.process:
+                worker.process.join(max(0, deadline - time.time()))
+                if worker.process.is_alive():
+                    logger.warning("worker %d [%d] didn't exit, killing it",
+                                   worker.wid, worker.pid)
+                    os.kill(worker.process.pid, signal.SIGKILL)
+                    worker.process.join()
+                worker.state = 'stopped'
+
+    def forward_signal(self, signum, frame=None):
+        for worker in self.workers:
+            if worker.process and worker.process.is_alive():
+                os.kill(worker.process.pid, signum)
+
+    def status(self):
+        return [dict(worker=w.wid, pid=w.pid, state=w.state,
+                     channels=list(w.channels), restarts=w.restarts,
+                     syncs=w.syncs, last_sync=w.last_sync,
+                     last_error=w.last_error)
+                for w in self.workers]
+
+    def log_status(self, level=logging.INFO):
+        for st in self.status():
+            logger.log(level, "worker %(worker)d [%(pid)s] %(state)s: "
+                       "channels %(channels)s, syncs %(syncs)d, "
+                       "restarts %(restarts)d", st)
+
+    def _start(self, worker):
+        worker.process = multiprocessing.Process(
+            target=self.target, name='worker-%d' % worker.wid,
+            args=(worker.wid, worker.channels, self.status_queue) + self.args)
+        worker.process.daemon = True
+        worker.process.start()
+        worker.pid = worker.process.pid
+        worker.started = time.time()
+        worker.restart_at = None
+        worker.state = 'starting'
+        logger.debug("worker %d started with pid %d", worker.wid, worker.pid)
+
+    def _drain_status(self, timeout):
+        block = True
+        while True:
+            try:
+                wid, event, value = self.status_queue.get(block, timeout)
+            except queue.Empty:
+                return
+            block = False
+            worker = self.workers[wid]
+            if event == 'running':
+                worker.state = 'running'
+                worker.pid = value
+                self.log_status(logging.DEBUG)
+            elif event == 'synced':
+                worker.syncs += value
+                worker.last_sync = time.time()
+            elif event == 'error':
+                worker.last_error = value
+
+    def _check_workers(self):
+        now = time.time()
+        for worker in self.workers:
+            if worker.restart_at is not None:
+                if now >= worker.restart_at:
+                    worker.restarts += 1
+                    self._start(worker)
+            elif not worker.process.is_alive():
+                delay = worker.backoff.next(worker.started, now)
+                worker.restart_at = now + delay
+                worker.state = 'crashed'
+                logger.error("worker %d [%d] exited with code %s, "
+                             "restarting in %ds", worker.wid, worker.pid,
+                             worker.process.exitcode, delay)
+                self.log_status()
@@ -0,0 +1,112 @@
+import logging
+import os
+from threading import Thread
+import time
+
+from .arguments import Arguments
+from .channels import get_channels
+from .config import read_config, ConfigError
+from .util import Backoff, get_user_ids
+
+
+logger = logging.getLogger(__name__)
+
+
+class Tenant:
+    """A user whose mbsyncrc is watched by a multi-tenant daemon."""
+
+    def __init__(self, user, config=None):
+        self.user = user
+        self.config = os.path.expanduser(config or '~%s/.mbsyncrc' % user)
+        self.home = os.path.expanduser('~%s' % user)
+        self.restarts = 0
+        self.backoff = Backoff()
+
+    @classmethod
+    def from_spec(cls, spec):
+        """Create tenant from USER[:CONFIG] string."""
+        user, _, config = spec.partition(':')
+        return cls(user, config or None)
+
+
+def check_maildirs(config, uid):
+    """Raise ConfigError if a maildir path of config exists and isn't owned
+    by uid: the daemon lists maildirs with its own privileges."""
+    for store in config.get('maildirstore', {}).values():
+        for option in ('path', 'inbox'):
+            value = store.get(option)
+            if value and os.path.exists(value) and \
+                    os.stat(value).st_uid != uid:
+                raise ConfigError("%s is not owned by the user" % value)
+
+
+def expand_home(config, home):
+    """Expand ~ in maildir paths to the tenant's home directory."""
+    for store in config.get('maildirstore', {}).values():
+        for option in ('path', 'inbox'):
+            value = store.get(option)
+            if value and (value == '~' or value.startswith('~/')):
+                store[option] = home + value[1:]
+    return config
+
+
+class TenantRunner:
+    """Watch all channels of every tenant in a separate thread.
+
+    target(channels, command, verbose, report, namespace, netmon, journal,
+    power, tiering) is called to watch a tenant's channels. If it fails, the
+    failure is logged and the tenant is restarted with exponential backoff
+    while other tenants continue.
+    """
+
+    def __init__(self, target, tenants, command, verbose=False, netmon=True,
+                 journal=None, power=None, tiering=None):
+        self.target = target
+        self.tenants = tenants
+        self.command = command
+        self.verbose = verbose
+        self.netmon = netmon
+        self.journal = journal
+        self.power = power
+        self.tiering = tiering
+
+    def run(self):
+        threads = []
+        for tenant in self.tenants:
+            t = Thread(target=self._run_tenant, args=(tenant,),
+                       name='tenant-%s' % tenant.user)
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        # keep the main thread responsive to signals
+        while any(t.is_alive() for t in threads):
+            time.sleep(1)
+
+    def _run_tenant(self, tenant):
+        while True:
+            started = time.time()
+            try:
+                self._watch(tenant)
+            except (Exception, SystemExit) as e:
+                logger.error("tenant %s: %s", tenant.user, e,
+                             exc_info=logger.isEnabledFor(logging.DEBUG))
+            delay = tenant.backoff.next(started)
+            logger.error("tenant %s: restarting in %ds", tenant.user, delay)
+            time.sleep(delay)
+            tenant.restarts += 1
+
+    def _watch(self, tenant):
+        # the config is read with the daemon's privileges
+        uid = get_user_ids(tenant.user)[0]
+        config = expand_home(read_config(tenant.config, owner=uid),
+                             tenant.home)
+        check_maildirs(config, uid)
+        args = Arguments()
+        args.all_ = True
+        args.pos_args = []
+        channels = get_channels(args, config)
+        logger.debug("tenant %s channels: %s", tenant.user, list(channels))
+        command = self.command.for_tenant(tenant.user, tenant.config)
+        journal = self.journal and '%s.%s' % (self.journal, tenant.user)
+        self.target(channels, command, self.verbose, None, tenant.user,
+                    self.netmon, journal, self.power, self.tiering)
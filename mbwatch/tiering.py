@@ -0,0 +1,278 @@
+"""Adaptive tiering of watched mailboxes between IDLE and polling."""
+
+from collections import deque
+import json
+import logging
+from threading import RLock, Thread
+import time
+
+from .cache import file_lock, write_atomic
+
+
+logger = logging.getLogger(__name__)
+
+
+class TierPolicy:
+    """Tiering settings.
+
+    A mailbox without events for cold_after seconds is demoted from its
+    own IDLE connection to polling. A polled mailbox is promoted back
+    after promote_events changes within promote_window seconds. If
+    max_idle is given, at most that many mailboxes IDLE and the least
+    recently active ones are polled.
+    """
+
+    # seconds between STATUS checks of polled mailboxes
+    poll_interval = 300
+    promote_events = 2
+    promote_window = 3600
+    report_interval = 3600
+
+    def __init__(self, cold_after=86400, max_idle=None):
+        self.cold_after = cold_after
+        self.max_idle = max_idle
+
+
+def _name(key):
+    return '%s:%s' % (key[0], key[1])
+
+
+class MailboxTiers:
+    """Event history and tier of every mailbox watched with IDLE.
+
+    keys are syncmap keys of the mailboxes. Polled ('cold') mailboxes are
+    blocked in gate, mailboxes with their own IDLE connection are 'hot'.
+    The time of the last event and the tier of every mailbox are saved to
+    path, so they survive restarts.
+    """
+
+    def __init__(self, policy, keys, gate, path=None):
+        self.policy = policy
+        self.gate = gate
+        self.path = path
+        self.lock = RLock()
+        now = time.time()
+        saved = self._load()
+        self.last = dict((key, saved.get(_name(key), {}).get('last', now))
+                         for key in keys)
+        self.events = dict((key, deque(maxlen=policy.promote_events))
+                           for key in keys)
+        self.cold = set(key for key in keys
+                        if saved.get(_name(key), {}).get('tier') == 'poll')
+        if self.cold:
+            gate.block(sorted(self.cold), 'cold')
+
+    def _read(self):
+        try:
+            with open(self.path) as file:
+                data = json.load(file)
+            if isinstance(data, dict):
+                return data
+        except (IOError, OSError):
+            return {}
+        except ValueError as e:
+            logger.warning("ignoring broken tiers file %s: %s", self.path, e)
+        return {}
+
+    def _load(self):
+        if not self.path:
+            return {}
+        return dict((name, entry) for name, entry in self._read().items()
+                    if isinstance(entry, dict) and 'last' in entry)
+
+    def save(self):
+        if not self.path:
+            return
+        try:
+            with file_lock(self.path):
+                # keep entries of other processes watching other stores
+                data = self._read()
+                with self.lock:
+                    for key, last in self.last.items():
+                        data[_name(key)] = {'last': last,
+                                            'tier': self.tier(key)}
+                write_atomic(self.path, json.dumps(data, sort_keys=True))
+        except (IOError, OSError) as e:
+            logger.warning("can't save mailbox tiers: %s", e)
+
+    def tier(self, key):
+        return 'poll' if key in self.cold else 'idle'
+
+    def event(self, key, now=None):
+        """Record a change of mailbox key. Return True if it's promoted."""
+        now = time.time() if now is None else now
+        with self.lock:
+            if key not in self.last:
+                return False
+            self.last[key] = now
+            events = self.events[key]
+            events.append(now)
+            if key not in self.cold or \
+                    len(events) < self.policy.promote_events or \
+                    now - events[0] > self.policy.promote_window:
+                return False
+            self.cold.discard(key)
+            logger.info("%s: %d changes in %ds, back to IDLE", _name(key),
+                        len(events), now - events[0])
+            demote = self._over_limit()
+        self.gate.unblock([key], 'cold')
+        self._demote(demote, 'more than %s mailboxes IDLE' %
+                     self.policy.max_idle)
+        self.save()
+        return True
+
+    def _over_limit(self):
+        """Return the least recently active hot mailboxes over max_idle."""
+        if self.policy.max_idle is None:
+            return []
+        hot = sorted((key for key in self.last if key not in self.cold),
+                     key=self.last.get)
+        return hot[:max(0, len(hot) - self.policy.max_idle)]
+
+    def _demote(self, keys, reason):
+        if not keys:
+            return
+        with self.lock:
+            self.cold.update(keys)
+            for key in keys:
+                self.events[key].clear()
+        for key in keys:
+            logger.info("%s: %s, polling", _name(key), reason)
+        self.gate.block(keys, 'cold')
+
+    def update(self, now=None):
+        """Demote mailboxes which became cold. Return demoted keys."""
+        now = time.time() if now is None else now
+        with self.lock:
+            quiet = [key for key, last in self.last.items()
+                     if key not in self.cold and
+                     now - last > self.policy.cold_after]
+            self.cold.update(quiet)
+            limited = self._over_limit()
+            self.cold.difference_update(quiet)
+        self._demote(quiet, 'no changes in %ds' % self.policy.cold_after)
+        self._demote(limited, 'more than %s mailboxes IDLE' %
+                     self.policy.max_idle)
+        if quiet or limited:
+            self.save()
+        return quiet + limited
+
+    def get_cold(self):
+        with self.lock:
+            return sorted(self.cold)
+
+    def report(self):
+        with self.lock:
+            tiers = sorted((_name(key), self.tier(key), last)
+                           for key, last in self.last.items())
+        now = time.time()
+        logger.info("mailbox tiers: %d IDLE, %d polled",
+                    sum(1 for _, tier, _ in tiers if tier == 'idle'),
+                    sum(1 for _, tier, _ in tiers if tier == 'poll'))
+        for name, tier, last in tiers:
+            logger.debug("%s: %s, last change %ds ago", name, tier,
+                         now - last)
+        self.save()
+
+
+class ColdPoller:
+    """Check polled mailboxes of tiers with STATUS every poll interval.
+
+    STATUS commands of a store are pipelined over one pooled connection.
+    callbacks is a dict {key: callback(received)}, the callback of a
+    mailbox is called when its UIDNEXT, UIDVALIDITY or number of messages
+    changes. Mailboxes polled for the first time after they were demoted
+    weren't watched for a while, so they are passed to catch_up(keys)
+    instead, which doesn't count as their activity. prime() records the
+    state of mailboxes cold at startup, which are synced with all the
+    others. If power manager is given, polls are aligned to its wakeup
+    windows in low-power mode.
+    """
+
+    def __init__(self, tiers, stores, cpool, callbacks, stop, power=None,
+                 catch_up=None):
+        self.tiers = tiers
+        self.stores = stores
+        self.cpool = cpool
+        self.callbacks = callbacks
+        self.stop = stop
+        self.power = power
+        self.catch_up = catch_up
+        # key -> last STATUS response
+        self.status = {}
+
+    def start(self):
+        t = Thread(target=self.run, name='tiering')
+        t.daemon = True
+        t.start()
+
+    def run(self):
+        policy = self.tiers.policy
+        reported = time.time()
+        interval = policy.poll_interval
+        while not self.stop.wait(self.power.poll_delay(interval)
+                                 if self.power else interval):
+            if self.power:
+                self.power.wakeup('poll')
+            try:
+                self.tiers.update()
+                self.poll()
+            except Exception as e:
+                logger.error("polling cold mailboxes failed: %s", e,
+                             exc_info=True)
+            if time.time() - reported >= policy.report_interval:
+                self.tiers.report()
+                reported = time.time()
+
+    def prime(self):
+        """Record the state of the mailboxes which are cold at startup."""
+        try:
+            self.poll(notify_new=False)
+        except Exception as e:
+            # they are synced on the first poll instead
+            logger.error("polling cold mailboxes failed: %s", e,
+                         exc_info=True)
+
+    def poll(self, notify_new=True):
+        from imaplib import IMAP4
+        import socket
+        from .imapidle import status_mailboxes
+        cold = self.tiers.get_cold()
+        # forget mailboxes promoted meanwhile
+        self.status = dict((key, self.status[key]) for key in cold
+                           if key in self.status)
+        bystore = {}
+        for key in cold:
+            bystore.setdefault(key[0], {})[key[2]] = key
+        for stname, keys in bystore.items():
+            store = self.stores[stname]
+            con = self.cpool.get_or_create_connection(
+                store['host'], store['user'], store['pass'],
+                store['port'], store['ssltype'])
+            received = time.time()
+            new = []
+            try:
+                for path, status in status_mailboxes(con, list(keys)):
+                    key = keys.get(path)
+                    if key is None or status is None:
+                        continue
+                    old = self.status.get(key)
+                    self.status[key] = status
+                    if old is None:
+                        if notify_new:
+                            new.append(key)
+                    elif old != status:
+                        logger.debug("%s changed: %s", path, status)
+                        self.callbacks[key](received)
+            except (IMAP4.abort, socket.error, OSError) as e:
+                logger.error("polling %s failed: %s", stname, e)
+                self.cpool.close(con)
+                con = None
+            except IMAP4.error as e:
+                logger.error("polling %s failed: %s", stname, e)
+            if con is not None:
+                self.cpool.release(con)
+            if new and self.catch_up:
+                logger.debug("catching up with %d demoted mailboxes",
+                             len(new))
+                self.catch_up(new)
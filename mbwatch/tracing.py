@@ -0,0 +1,128 @@
+"""Opt-in per-event tracing.
+
+Every mailbox event (an IDLE notification or a detected maildir change) gets
+a correlation id which is recorded together with a timestamp at each stage
+of its processing: 'event', 'enqueue', 'dequeue', 'sync_start' and
+'sync_end'. Records are written as JSON lines to a rotating file.
+
+Run ``python -m mbwatch.tracing FILE...`` to print latency percentiles.
+"""
+
+from collections import defaultdict
+import itertools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+
+_trace_logger = logging.getLogger(__name__ + '.records')
+_trace_logger.propagate = False
+_trace_logger.setLevel(logging.INFO)
+
+_ids = itertools.count(1)
+_enabled = False
+
+STAGES = ('event', 'enqueue', 'dequeue', 'sync_start', 'sync_end')
+
+
+def setup_tracing(path, max_bytes=10*1024*1024, backup_count=3):
+    """Start writing trace records to path."""
+    global _enabled
+    import logging.handlers
+    handler = logging.handlers.RotatingFileHandler(
+        os.path.expanduser(path), maxBytes=max_bytes,
+        backupCount=backup_count)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    _trace_logger.addHandler(handler)
+    _enabled = True
+
+
+def new_id():
+    """Return a new correlation id or None if tracing is disabled."""
+    if _enabled:
+        return '%d-%d' % (os.getpid(), next(_ids))
+
+
+def record(cid, stage, timestamp=None, **fields):
+    """Record that the event cid reached stage."""
+    if not _enabled or cid is None:
+        return
+    fields.update(id=cid, stage=stage, time=timestamp or time.time(),
+                  thread=threading.current_thread().name)
+    _trace_logger.info(json.dumps(fields, sort_keys=True))
+
+
+def record_all(cids, stage, **fields):
+    timestamp = time.time()
+    for cid in cids:
+        record(cid, stage, timestamp, **fields)
+
+
+def read_records(paths):
+    events = defaultdict(dict)
+    for path in paths:
+        with open(path) as file:
+            for line in file:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    continue
+                events[rec['id']][rec['stage']] = rec
+    return events
+
+
+def percentile(values, pct):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    k = (len(values) - 1) * pct / 100.0
+    lo = int(k)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+def latency_breakdown(events):
+    """Return {interval name: [seconds, ...]} for completed events."""
+    intervals = [('delivery', 'event', 'enqueue'),
+                 ('queue', 'enqueue', 'dequeue'),
+                 ('dispatch', 'dequeue', 'sync_start'),
+                 ('sync', 'sync_start', 'sync_end'),
+                 ('total', 'event', 'sync_end')]
+    result = defaultdict(list)
+    for stages in events.values():
+        if 'sync_end' not in stages:
+            continue
+        source = stages.get('event', {}).get('source', 'unknown')
+        for name, start, end in intervals:
+            if start in stages and end in stages:
+                delta = stages[end]['time'] - stages[start]['time']
+                result[name].append(delta)
+                result['%s:%s' % (source, name)].append(delta)
+    return result
+
+
+def print_report(events, out=sys.stdout):
+    breakdown = latency_breakdown(events)
+    pending = sum(1 for stages in events.values() if 'sync_end' not in stages)
+    out.write("%d events, %d not completed\n" % (len(events), pending))
+    out.write("%-18s %7s %9s %9s %9s %9s\n" %
+              ('interval', 'count', 'p50', 'p90', 'p99', 'max'))
+    for name in sorted(breakdown):
+        values = breakdown[name]
+        out.write("%-18s %7d %9.3f %9.3f %9.3f %9.3f\n" % (
+            name, len(values), percentile(values, 50),
+            percentile(values, 90), percentile(values, 99), max(values)))
+
+
+def main():
+    if len(sys.argv) < 2:
+        sys.stderr.write("usage: python -m mbwatch.tracing FILE...\n")
+        raise SystemExit(2)
+    print_report(read_records(sys.argv[1:]))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,7 @@
-import ctypes.util
-import getpass
 import logging
+import os
 import sys
-import subprocess
+import time
 
 
 logger = logging.getLogger(__name__)
@@ -12,23 +11,90 @@ class PasswordError(Exception):
     pass
 
 
-def get_password(store):
+class Backoff:
+    """Exponential delay between restarts of something that failed.
+
+    The delay doubles from minimum up to maximum on every failure and is
+    reset when the failed run lasted more than stable_time seconds.
+    """
+
+    def __init__(self, minimum=5, maximum=300, stable_time=600):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.stable_time = stable_time
+        self.delay = 0
+
+    def next(self, started, now=None):
+        """Return seconds to wait after a failure of run started at
+        started."""
+        now = time.time() if now is None else now
+        if now - started > self.stable_time:
+            self.delay = 0
+        self.delay = min(self.maximum, max(self.minimum, self.delay * 2))
+        return self.delay
+
+
+def get_user_env(user):
+    """Return environment for running commands as user."""
+    import pwd
+    pw = pwd.getpwnam(user)
+    env = dict(os.environ)
+    env.update(HOME=pw.pw_dir, USER=pw.pw_name, LOGNAME=pw.pw_name)
+    return env
+
+
+def get_user_ids(user):
+    """Return (uid, gid, groups) of user. Look them up before fork: NSS
+    lookups in a forked child of a threaded process can deadlock."""
+    import pwd
+    pw = pwd.getpwnam(user)
+    if hasattr(os, 'getgrouplist'):
+        groups = os.getgrouplist(pw.pw_name, pw.pw_gid)
+    else:
+        import grp
+        groups = [pw.pw_gid] + [gr.gr_gid for gr in grp.getgrall()
+                                if pw.pw_name in gr.gr_mem]
+    return pw.pw_uid, pw.pw_gid, groups
+
+
+def demote(ids):
+    """Switch the current process to (uid, gid, groups) returned by
+    get_user_ids."""
+    uid, gid, groups = ids
+    if uid == os.geteuid():
+        return
+    os.setgroups(groups)
+    os.setgid(gid)
+    os.setuid(uid)
+
+
+def get_password(store, user=None):
+    """Return password of the store running PassCmd as user if given."""
+    import subprocess
     passwd = None
     if 'pass' in store:
         passwd = store['pass']
     elif 'passcmd' in store:
+        kwargs = {}
+        if user:
+            ids = get_user_ids(user)
+            kwargs = dict(preexec_fn=lambda: demote(ids),
+                          env=get_user_env(user))
         try:
-            passwd = subprocess.check_output(store['passcmd'], shell=True)
+            passwd = subprocess.check_output(store['passcmd'], shell=True,
+                                             **kwargs)
             passwd = passwd.decode(sys.stdout.encoding or 'UTF-8')
-        except (OSError, subprocess.CalledProcessError,
+        except (OSError, KeyError, subprocess.CalledProcessError,
                 UnicodeDecodeError) as e:
             raise PasswordError('getting password failed: ' + str(e))
     else:
+        from getpass import getpass
         passwd = getpass("Password (%s):" % store.get('imapstore'))
     return passwd
 
 
 def __load_res_init():
+    import ctypes.util
 
     c = None
     so = ctypes.util.find_library('c')
@@ -46,4 +112,12 @@ def __load_res_init():
     return res_init
 
 
-res_init = __load_res_init()
+_res_init = None
+
+
+def res_init():
+    """Reload resolver configuration. libc is loaded on the first call."""
+    global _res_init
+    if _res_init is None:
+        _res_init = __load_res_init()
+    return _res_init()